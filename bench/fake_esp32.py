@@ -0,0 +1,100 @@
+"""Stand-in for the ESP32-CAM: serves an MJPEG /stream replaying recorded JPEGs and accepts /update_lcd.
+
+Usage:
+    python bench/fake_esp32.py --port 8081 --frames bench/frames
+    python bench/fake_esp32.py --record http://<esp32-ip>:81/stream --frames bench/frames --count 100
+
+Point the server at it with ESP32_IP=127.0.0.1:8081 ESP32_STREAM=http://127.0.0.1:8081/stream.
+"""
+import argparse
+import glob
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+lcd_messages = 0
+lcd_lock = threading.Lock()
+
+def load_frames(path):
+    frames = [open(f, "rb").read() for f in sorted(glob.glob(os.path.join(path, "*.jpg")))] if path else []
+    if frames: return frames
+    # No recordings: synthesize a few noisy VGA frames so the decode/encode paths still do real work
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(0)
+    for i in range(10):
+        img = rng.integers(0, 255, (480, 640, 3), dtype=np.uint8)
+        cv2.putText(img, f"frame {i}", (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        frames.append(cv2.imencode(".jpg", img)[1].tobytes())
+    return frames
+
+def record(url, out_dir, count):
+    import requests
+    os.makedirs(out_dir, exist_ok=True)
+    buf, saved = b"", 0
+    for chunk in requests.get(url, stream=True, timeout=5).iter_content(chunk_size=4096):
+        buf += chunk
+        a = buf.find(b"\xff\xd8"); b = buf.find(b"\xff\xd9")
+        if a != -1 and b != -1:
+            with open(os.path.join(out_dir, f"{saved:05d}.jpg"), "wb") as f: f.write(buf[a:b + 2])
+            buf, saved = buf[b + 2:], saved + 1
+            if saved >= count: break
+    print(f"Recorded {saved} frames to {out_dir}")
+
+def make_handler(frames, fps):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args): pass
+
+        def do_GET(self):
+            global lcd_messages
+            url = urlparse(self.path)
+            if url.path == "/stream":
+                self.send_response(200)
+                self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+                self.end_headers()
+                i = 0
+                try:
+                    while True:
+                        jpg = frames[i % len(frames)]
+                        self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: " + str(len(jpg)).encode() + b"\r\n\r\n" + jpg + b"\r\n")
+                        i += 1
+                        time.sleep(1 / fps)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+            elif url.path == "/update_lcd":
+                with lcd_lock: lcd_messages += 1
+                body = b"OK"
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            elif url.path == "/stats":
+                body = f"lcd_messages {lcd_messages}\n".encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_error(404)
+    return Handler
+
+def main():
+    ap = argparse.ArgumentParser(description="Fake ESP32-CAM for benchmarks")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--frames", help="directory of recorded .jpg frames")
+    ap.add_argument("--fps", type=float, default=15)
+    ap.add_argument("--record", metavar="URL", help="record frames from a real ESP32 stream into --frames and exit")
+    ap.add_argument("--count", type=int, default=100)
+    args = ap.parse_args()
+    if args.record:
+        return record(args.record, args.frames or "frames", args.count)
+    frames = load_frames(args.frames)
+    print(f"Serving {len(frames)} frames at {args.fps} fps on :{args.port}")
+    ThreadingHTTPServer(("0.0.0.0", args.port), make_handler(frames, args.fps)).serve_forever()
+
+if __name__ == "__main__":
+    main()
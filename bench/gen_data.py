@@ -0,0 +1,109 @@
+"""Populates a database with synthetic students, classes, rosters and a semester of attendance.
+
+Usage: python bench/gen_data.py --db bench.db --students 5000 --classes 200 [--frames bench/frames]
+
+With --frames, every distinct face found in the recorded frames is enrolled as one of the students and
+added to every class, so the fake ESP32 replaying those frames drives /capture_attendance's match path.
+"""
+import argparse
+import glob
+import os
+import random
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROGRAMS = ["BSCPE", "BSCS", "BSIT", "BSEE", "BSME"]
+YEARS = ["1st", "2nd", "3rd", "4th"]
+DAY_PATTERNS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "MWF", "TTh"]
+FIRST_NAMES = ["Juan", "Maria", "Jose", "Ana", "Mark", "Grace", "Paolo", "Bea", "Carlo", "Liza", "Miguel", "Rica"]
+LAST_NAMES = ["Santos", "Reyes", "Cruz", "Bautista", "Garcia", "Mendoza", "Torres", "Flores", "Ramos", "Aquino"]
+
+def frame_encodings(path, same_person=0.45):
+    """Encodes the single face in each recorded frame, keeping one encoding per distinct person."""
+    import face_recognition
+    encs = []
+    for f in sorted(glob.glob(os.path.join(path, "*.jpg"))):
+        img = face_recognition.load_image_file(f)
+        locations = face_recognition.face_locations(img)
+        if len(locations) != 1: continue
+        enc = face_recognition.face_encodings(img, locations)[0]
+        if encs and min(face_recognition.face_distance(encs, enc)) < same_person: continue
+        encs.append(enc)
+    return encs
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--db", required=True)
+    ap.add_argument("--students", type=int, default=2000)
+    ap.add_argument("--classes", type=int, default=100)
+    ap.add_argument("--class-size", type=int, default=40)
+    ap.add_argument("--weeks", type=int, default=18, help="weeks of the term already held (with attendance)")
+    ap.add_argument("--weeks-ahead", type=int, default=8,
+                    help="weeks the term still runs after today; keeps classes out of term archiving while the DB is reused")
+    ap.add_argument("--sections", type=int, default=4, help="sections per program and year")
+    ap.add_argument("--username", default="bench")
+    ap.add_argument("--password", default="bench")
+    ap.add_argument("--seed", type=int, default=135)
+    ap.add_argument("--frames", help="directory of recorded .jpg frames whose faces should be enrolled")
+    args = ap.parse_args()
+
+    if os.path.exists(args.db): sys.exit(f"{args.db} already exists; pick a fresh path")
+    enrolled = frame_encodings(args.frames)[:args.students] if args.frames else []
+    if args.frames and not enrolled: sys.exit(f"No single-face frames found in {args.frames}")
+    os.environ["ATTENDANCE_DB"] = args.db
+    import server
+    server.init_db()
+    server.register_professor(args.username, args.password)
+
+    rng = random.Random(args.seed)
+    nprng = np.random.default_rng(args.seed)
+    with sqlite3.connect(args.db) as c:
+        pid = c.execute("SELECT id FROM professors WHERE username=?", (args.username,)).fetchone()[0]
+
+        students = []
+        for i in range(args.students):
+            fn, ln = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            prog, yr = rng.choice(PROGRAMS), rng.choice(YEARS)
+            sec = f"{YEARS.index(yr) + 1}-{rng.randint(1, args.sections)}"
+            enc = nprng.normal(0, 0.1, 128).astype(np.float64)
+            if i < len(enrolled): enc = enrolled[i]
+            students.append((f"2026{i:06d}", ln, fn, "", yr, prog, sec, "", f"{fn} {ln}", enc.tobytes()))
+        c.executemany('''INSERT INTO students (student_number, last_name, first_name, middle_name, year, program, section, suffix, name, encoding)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', students)
+
+        today = datetime.now().date()
+        start = today - timedelta(weeks=args.weeks)
+        end = today + timedelta(weeks=args.weeks_ahead)
+        attendance = []
+        for n in range(args.classes):
+            day = rng.choice(DAY_PATTERNS)
+            hour = rng.randint(7, 17)
+            prog, yr = rng.choice(PROGRAMS), rng.choice(YEARS)
+            sec = f"{YEARS.index(yr) + 1}-{rng.randint(1, args.sections)}"
+            cur = c.execute('''INSERT INTO classes (professor_id, name, day, start_time, end_time, start_date, end_date, program, year, section)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                            (pid, f"SUBJ {100 + n}", day, f"{hour:02d}:00", f"{hour + 1:02d}:30", str(start), str(end), prog, yr, sec))
+            cid = cur.lastrowid
+            roster = rng.sample(students, min(args.class_size, len(students)))
+            roster += [s for s in students[:len(enrolled)] if s not in roster]
+            c.executemany("INSERT INTO class_students (class_id, student_number) VALUES (?, ?)", [(cid, s[0]) for s in roster])
+            for date in server.meeting_dates(day, str(start), str(today)):
+                for s in roster:
+                    roll = rng.random()
+                    if roll < 0.8: attendance.append((cid, s[0], f"{date} {hour:02d}:{rng.randint(0, 14):02d}:00", "on_time"))
+                    elif roll < 0.9: attendance.append((cid, s[0], f"{date} {hour:02d}:{rng.randint(16, 59):02d}:00", "late"))
+        c.executemany("INSERT INTO attendance (class_id, student_number, timestamp, status) VALUES (?, ?, ?, ?)", attendance)
+        c.commit()
+    server.rebuild_rollups()
+    if enrolled: print(f"Enrolled {len(enrolled)} faces from {args.frames} as students {students[0][0]}..{students[len(enrolled) - 1][0]} in every class")
+    print(f"Wrote {args.students} students, {args.classes} classes, {len(attendance)} attendance rows to {args.db}")
+    print(f"Login: {args.username} / {args.password}")
+    print(f"Classes end on {end}; after that the server archives them and benchmarks stop measuring the live path")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Scripted load scenarios against a running attendance server; reports p50/p99 latency and throughput per route.
+
+Usage:
+    python bench/load.py --url http://127.0.0.1:8000 --dashboards 8 --exporters 2 --viewers 2 --duration 30
+
+Each dashboard worker mimics an open dashboard tab (capture_attendance, attendance, get_students);
+each exporter cycles through the CSV exports; each viewer holds /stream open and counts frames.
+With --interval 0 (default) workers run closed-loop as fast as the server answers.
+"""
+import argparse
+import json
+import random
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+results = defaultdict(list)  # route -> [latency seconds]
+errors = defaultdict(int)
+results_lock = threading.Lock()
+
+def percentile(values, pct):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+def login(base, username, password):
+    s = requests.Session()
+    r = s.post(f"{base}/login", data={"username": username, "password": password}, allow_redirects=False)
+    if r.status_code != 302: raise SystemExit(f"Login failed for {username}: HTTP {r.status_code}")
+    return s
+
+def timed_get(s, base, route, params=None):
+    start = time.perf_counter()
+    try:
+        r = s.get(f"{base}{route}", params=params, timeout=30)
+        ok = r.status_code < 500
+        r.content
+    except requests.RequestException:
+        ok = False
+    elapsed = time.perf_counter() - start
+    with results_lock:
+        results[route].append(elapsed)
+        if not ok: errors[route] += 1
+
+def dashboard_worker(s, base, class_ids, stop, interval):
+    rng = random.Random()
+    cid = rng.choice(class_ids)
+    while not stop.is_set():
+        timed_get(s, base, "/capture_attendance", {"class_id": cid})
+        timed_get(s, base, "/attendance", {"class_id": cid})
+        timed_get(s, base, "/get_students", {"search_type": "last_name", "search_val": rng.choice("aeiou"), "limit": 10})
+        if interval: stop.wait(interval)
+
+def export_worker(s, base, class_ids, stop, interval):
+    rng = random.Random()
+    while not stop.is_set():
+        cid = rng.choice(class_ids)
+        timed_get(s, base, "/export_session", {"class_id": cid, "date": time.strftime("%Y-%m-%d")})
+        timed_get(s, base, "/export_course", {"class_id": cid})
+        timed_get(s, base, "/export_all_attendance")
+        if interval: stop.wait(interval)
+
+def stream_viewer(s, base, stop, frame_counts):
+    frames = 0
+    try:
+        with s.get(f"{base}/stream", stream=True, timeout=10) as r:
+            for chunk in r.iter_content(chunk_size=16384):
+                frames += chunk.count(b"--frame")
+                if stop.is_set(): break
+    except requests.RequestException:
+        with results_lock: errors["/stream"] += 1
+    frame_counts.append(frames)
+
+def main():
+    ap = argparse.ArgumentParser(description="Attendance server load test")
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--username", default="bench")
+    ap.add_argument("--password", default="bench")
+    ap.add_argument("--db", help="database written by gen_data.py; used to pick class ids")
+    ap.add_argument("--class-ids", help="comma-separated class ids (default: all of the professor's classes in --db, else 1)")
+    ap.add_argument("--dashboards", type=int, default=4)
+    ap.add_argument("--exporters", type=int, default=1)
+    ap.add_argument("--viewers", type=int, default=1)
+    ap.add_argument("--duration", type=float, default=30)
+    ap.add_argument("--interval", type=float, default=0, help="seconds each worker sleeps between iterations")
+    ap.add_argument("--json", help="also write results to this file")
+    args = ap.parse_args()
+
+    base = args.url.rstrip("/")
+    if args.class_ids:
+        class_ids = [int(x) for x in args.class_ids.split(",")]
+    elif args.db:
+        with sqlite3.connect(args.db) as c:
+            class_ids = [r[0] for r in c.execute("SELECT c.id FROM classes c JOIN professors p ON c.professor_id = p.id WHERE p.username=?", (args.username,))]
+    else:
+        class_ids = [1]
+
+    stop = threading.Event()
+    frame_counts = []
+    threads = []
+    for _ in range(args.dashboards):
+        threads.append(threading.Thread(target=dashboard_worker, args=(login(base, args.username, args.password), base, class_ids, stop, args.interval)))
+    for _ in range(args.exporters):
+        threads.append(threading.Thread(target=export_worker, args=(login(base, args.username, args.password), base, class_ids, stop, args.interval)))
+    for _ in range(args.viewers):
+        threads.append(threading.Thread(target=stream_viewer, args=(login(base, args.username, args.password), base, stop, frame_counts)))
+
+    started = time.perf_counter()
+    for t in threads: t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads: t.join(timeout=35)
+    elapsed = time.perf_counter() - started
+
+    report = {"duration_s": round(elapsed, 2), "routes": {}}
+    print(f"{'route':<24}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for route in sorted(results):
+        lat = results[route]
+        row = {"count": len(lat), "errors": errors[route], "rps": round(len(lat) / elapsed, 2),
+               "p50_ms": round(percentile(lat, 50) * 1000, 2), "p99_ms": round(percentile(lat, 99) * 1000, 2),
+               "max_ms": round(max(lat) * 1000, 2)}
+        report["routes"][route] = row
+        print(f"{route:<24}{row['count']:>8}{row['errors']:>8}{row['rps']:>10}{row['p50_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    if frame_counts:
+        fps = [n / elapsed for n in frame_counts]
+        report["stream"] = {"viewers": len(fps), "min_fps": round(min(fps), 2), "mean_fps": round(sum(fps) / len(fps), 2), "errors": errors["/stream"]}
+        print(f"/stream viewers={len(fps)} mean_fps={report['stream']['mean_fps']} min_fps={report['stream']['min_fps']}")
+    if args.json:
+        with open(args.json, "w") as f: json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Measures cold-start time and peak RSS of server.py for each worker role.
+
+Usage: python bench/startup.py --runs 5
+
+Each run is a fresh interpreter that imports server, runs init_db and, for the vision roles,
+loads the vision stack the way `python server.py` does before serving.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, resource, sys, time
+t0 = time.perf_counter()
+import server
+server.init_db()
+t_import = time.perf_counter() - t0
+if server.ROLE != "web": server.load_vision()
+t_ready = time.perf_counter() - t0
+print(json.dumps({"import_s": t_import, "ready_s": t_ready, "maxrss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+
+def run(role, db):
+    env = dict(os.environ, ATTENDANCE_ROLE=role, ATTENDANCE_DB=db)
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main():
+    ap = argparse.ArgumentParser(description="Startup time and memory per role")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--roles", default="web,vision")
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "startup.db")
+        print(f"{'role':<8}{'import s':>10}{'ready s':>10}{'RSS MB':>10}")
+        for role in args.roles.split(","):
+            samples = [run(role, db) for _ in range(args.runs)]
+            med = {k: statistics.median(s[k] for s in samples) for k in samples[0]}
+            print(f"{role:<8}{med['import_s']:>10.3f}{med['ready_s']:>10.3f}{med['maxrss_mb']:>10.1f}")
+
+if __name__ == "__main__":
+    main()
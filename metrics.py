@@ -0,0 +1,172 @@
+"""Lightweight in-process metrics: latency histograms, counters, gauges and a sampling profiler.
+
+Everything is kept in module-level registries guarded by one lock and rendered in the
+Prometheus text exposition format by render().
+"""
+import sys
+import time
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+
+# Upper bounds in seconds; tuned for a request path that ranges from sub-millisecond
+# cache hits to multi-second face detection.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MIN_PROFILE_INTERVAL = 0.001
+
+HELP = {
+    "attendance_stage_seconds": "Time spent in each stage of /capture_attendance.",
+    "capture_requests_total": "Recognition attempts by outcome.",
+    "db_query_seconds": "Time spent in database helpers.",
+    "stream_frame_decode_seconds": "JPEG decode time for frames pulled from the ESP32 stream.",
+    "stream_frames_total": "Frames decoded from the ESP32 stream.",
+    "stream_reconnects_total": "Reconnects to the ESP32 stream.",
+    "stream_fps": "Frames per second decoded from the ESP32 stream.",
+    "mjpeg_encode_seconds": "JPEG encode time for frames served on /stream.",
+    "mjpeg_frames_total": "Frames sent to /stream viewers.",
+    "import_seconds": "Time spent importing lazily loaded libraries.",
+    "image_write_seconds": "Time spent writing enrollment photos in the background.",
+    "thumbnail_seconds": "Time spent generating student photo thumbnails on a cache miss.",
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # (name, labels) -> value
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None: h = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                h[i] += 1
+                break
+        else:
+            h[len(BUCKETS)] += 1
+        h[-1] += seconds
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock: _counters[key] = _counters.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    with _lock: _gauges[_key(name, labels)] = value
+
+@contextmanager
+def span(name, **labels):
+    """Times the enclosed block into histogram `name`."""
+    start = time.perf_counter()
+    try: yield
+    finally: observe(name, time.perf_counter() - start, **labels)
+
+def timed(name, **labels):
+    """Decorator form of span()."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with span(name, **labels): return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+def _fmt_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs: return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pairs) + "}"
+
+def _header(lines, seen, name, kind):
+    if name in seen: return
+    seen.add(name)
+    if name in HELP: lines.append(f"# HELP {name} {HELP[name]}")
+    lines.append(f"# TYPE {name} {kind}")
+
+def render():
+    """Returns all metrics in the Prometheus text exposition format."""
+    with _lock:
+        hists = {k: list(v) for k, v in _histograms.items()}
+        counters, gauges = dict(_counters), dict(_gauges)
+    lines, seen = [], set()
+    for (name, labels), h in sorted(hists.items()):
+        _header(lines, seen, name, "histogram")
+        cumulative = 0
+        for bound, n in zip(BUCKETS, h):
+            cumulative += n
+            lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', bound)])} {cumulative}")
+        cumulative += h[len(BUCKETS)]
+        lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {cumulative}")
+        lines.append(f"{name}_sum{_fmt_labels(labels)} {h[-1]}")
+        lines.append(f"{name}_count{_fmt_labels(labels)} {cumulative}")
+    for (name, labels), v in sorted(counters.items()):
+        _header(lines, seen, name, "counter")
+        lines.append(f"{name}{_fmt_labels(labels)} {v}")
+    for (name, labels), v in sorted(gauges.items()):
+        _header(lines, seen, name, "gauge")
+        lines.append(f"{name}{_fmt_labels(labels)} {v}")
+    return "\n".join(lines) + "\n"
+
+# ================= SAMPLING PROFILER =================
+_profile = Counter()
+_profile_samples = 0
+_profiler_thread = None
+_profiler_stop = threading.Event()
+
+def _sample_loop(interval):
+    global _profile_samples
+    me = threading.get_ident()
+    while not _profiler_stop.wait(interval):
+        stacks = []
+        for tid, frame in sys._current_frames().items():
+            if tid == me: continue
+            parts = []
+            while frame is not None:
+                code = frame.f_code
+                parts.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            stacks.append(";".join(reversed(parts)))
+        with _lock:
+            _profile.update(stacks)
+            _profile_samples += 1
+
+def start_profiler(interval=0.01):
+    """Starts sampling every thread's stack every `interval` seconds (at least 1 ms). No-op if already running."""
+    global _profiler_thread
+    interval = max(interval, MIN_PROFILE_INTERVAL)
+    with _lock:
+        if _profiler_thread is not None: return False
+        _profiler_stop.clear()
+        _profiler_thread = threading.Thread(target=_sample_loop, args=(interval,), daemon=True)
+        _profiler_thread.start()
+    return True
+
+def stop_profiler():
+    global _profiler_thread
+    with _lock:
+        t, _profiler_thread = _profiler_thread, None
+    if t is None: return False
+    _profiler_stop.set()
+    t.join()
+    return True
+
+def profiler_running():
+    return _profiler_thread is not None
+
+def reset_profile():
+    global _profile_samples
+    with _lock:
+        _profile.clear()
+        _profile_samples = 0
+
+def profile_folded(limit=None):
+    """Returns collected stacks in folded format ("a;b;c count"), ready for flamegraph tools."""
+    with _lock: top = _profile.most_common(limit)
+    return "\n".join(f"{stack} {n}" for stack, n in top) + "\n"
+
+def profile_summary(limit=20):
+    with _lock:
+        return {"running": profiler_running(), "samples": _profile_samples,
+                "top": [{"stack": stack, "count": n} for stack, n in _profile.most_common(limit)]}
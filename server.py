@@ -1,36 +1,118 @@
-import cv2
-import numpy as np
-import face_recognition
 from flask import Flask, jsonify, render_template, request, Response, session, redirect, url_for, make_response
 import sqlite3
 import os
 import time
 import threading
-import requests
+import atexit
+import signal
+import sys
+import functools
+import hashlib
+import queue
+import multiprocessing
 import urllib.parse
 import csv
+import gzip
+import json
+import re
+import bisect
 from io import StringIO
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
+import metrics
+from metrics import span, timed
 
 # ================= CONFIGURATION =================
-ESP32_IP = "10.98.88.138" 
-ESP32_STREAM = f"http://{ESP32_IP}:81/stream"
+ESP32_IP = os.environ.get("ESP32_IP", "10.98.88.138")
+ESP32_STREAM = os.environ.get("ESP32_STREAM", f"http://{ESP32_IP}:81/stream")
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB = os.path.join(BASE_DIR, "attendance.db")
+DB = os.environ.get("ATTENDANCE_DB", os.path.join(BASE_DIR, "attendance.db"))
 UPLOADS = os.path.join(BASE_DIR, "student_images")
+ARCHIVE_DIR = os.environ.get("ATTENDANCE_ARCHIVE_DIR", os.path.join(BASE_DIR, "attendance_archive"))
 
 os.makedirs(UPLOADS, exist_ok=True)
 SECRET_KEY = "your_secret_key_here"
 LATE_THRESHOLD = 15
+ATTENDANCE_FLUSH_MS = 250
+META_CACHE_TTL = 30
+THUMB_CACHE_BYTES = 16 * 1024 * 1024
+THUMB_SIZES = (48, 96, 128, 256)
+# Recognition settings; changing them calls for POST /reencode_faces so stored encodings match
+FACE_DETECTION_MODEL = os.environ.get("FACE_DETECTION_MODEL", "hog")
+FACE_NUM_JITTERS = int(os.environ.get("FACE_NUM_JITTERS", 1))
+REENCODE_WORKERS = int(os.environ.get("REENCODE_WORKERS", os.cpu_count() or 1))
+# "web" serves pages, search and exports without loading the vision stack or the camera;
+# "vision" and "all" also pull frames from the ESP32 and handle recognition routes.
+ROLE = os.environ.get("ATTENDANCE_ROLE", "all")
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 
+# Heavy libraries are imported on first use; see load_vision() and load_http()
+cv2 = np = face_recognition = requests = None
+import_lock = threading.Lock()
+
 current_frame = None
 frame_lock = threading.Lock()
 
+# Write-behind attendance buffer: (class_id, student_number, date) -> (timestamp, status)
+pending_attendance = {}
+inflight_attendance = {}  # the batch a flush is writing right now, still visible to reads until it commits
+attendance_lock = threading.Lock()
+flush_lock = threading.Lock()
+attendance_flusher = None
+
+# Class/student metadata used on the recognition hot path
+meta_cache = {}
+meta_lock = threading.Lock()
+
+# ================= LAZY IMPORTS =================
+def load_imaging():
+    """Imports OpenCV and numpy on first use (enough for thumbnails)."""
+    global cv2, np
+    if cv2 is not None: return
+    with import_lock:
+        if cv2 is not None: return
+        with span("import_seconds", module="imaging"):
+            import cv2 as _cv2
+            import numpy as _np
+        np = _np
+        cv2 = _cv2
+
+def load_vision():
+    """Imports OpenCV, numpy and face_recognition (dlib and its models) on first use."""
+    global face_recognition
+    load_imaging()
+    if face_recognition is not None: return
+    with import_lock:
+        if face_recognition is not None: return
+        with span("import_seconds", module="vision"):
+            import face_recognition as _face_recognition
+        face_recognition = _face_recognition
+
+def load_http():
+    global requests
+    if requests is not None: return
+    with import_lock:
+        if requests is None:
+            import requests as _requests
+            requests = _requests
+
+def vision_route(fn):
+    """Refuses the route on web-only workers; otherwise makes sure the vision stack is loaded.
+    Unauthenticated requests go straight to the route's own 403 without importing anything."""
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+        if ROLE == "web": return jsonify({"error": "Camera routes are served by the vision worker"}), 503
+        if "professor_id" not in session: return fn(*args, **kwargs)
+        load_vision()
+        load_http()
+        return fn(*args, **kwargs)
+    return inner
+
 # ================= DATABASE FUNCTIONS =================
 def init_db():
     print(f"Connecting to database at: {DB}")
@@ -54,6 +136,20 @@ def init_db():
         cur.execute('''CREATE TABLE IF NOT EXISTS students (id INTEGER PRIMARY KEY AUTOINCREMENT, student_number TEXT UNIQUE, last_name TEXT, first_name TEXT, middle_name TEXT, year TEXT, program TEXT, section TEXT, suffix TEXT, name TEXT, encoding BLOB)''')
         cur.execute('''CREATE TABLE IF NOT EXISTS class_students (class_id INTEGER, student_number TEXT, FOREIGN KEY(class_id) REFERENCES classes(id), FOREIGN KEY(student_number) REFERENCES students(student_number))''')
         cur.execute('''CREATE TABLE IF NOT EXISTS attendance (id INTEGER PRIMARY KEY AUTOINCREMENT, class_id INTEGER, student_number TEXT, timestamp TEXT, status TEXT)''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS holidays (date TEXT PRIMARY KEY, name TEXT)''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS class_cancellations (class_id INTEGER, date TEXT, PRIMARY KEY (class_id, date))''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS attendance_archives (class_id INTEGER PRIMARY KEY, term TEXT, path TEXT, snapshot TEXT, archived_at TEXT)''')
+        new_rollups = not cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='rollup_student_class'").fetchone()
+        cur.execute('''CREATE TABLE IF NOT EXISTS rollup_student_class (class_id INTEGER, student_number TEXT, on_time INTEGER DEFAULT 0, late INTEGER DEFAULT 0, PRIMARY KEY (class_id, student_number))''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS rollup_student (student_number TEXT PRIMARY KEY, classes INTEGER, sessions INTEGER, on_time INTEGER, late INTEGER, rate REAL)''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS rollup_meta (key TEXT PRIMARY KEY, value TEXT)''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_rollup_student_rate ON rollup_student (rate)")
+        cur.execute('''CREATE TABLE IF NOT EXISTS rollup_class_week (class_id INTEGER, week TEXT, on_time INTEGER DEFAULT 0, late INTEGER DEFAULT 0, PRIMARY KEY (class_id, week))''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_attendance_class_student ON attendance (class_id, student_number)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_class_students_class ON class_students (class_id, student_number)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_class_students_student ON class_students (student_number)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_attendance_class_time ON attendance (class_id, timestamp)")
+        cur.execute("PRAGMA journal_mode=WAL")
         c.commit()
         
         # Migrations
@@ -64,6 +160,9 @@ def init_db():
         if 'program' not in cols: cur.execute("ALTER TABLE classes ADD COLUMN program TEXT")
         if 'year' not in cols: cur.execute("ALTER TABLE classes ADD COLUMN year TEXT")
         if 'section' not in cols: cur.execute("ALTER TABLE classes ADD COLUMN section TEXT")
+        cur.execute("PRAGMA table_info(students)")
+        if 'image_hash' not in [col[1] for col in cur.fetchall()]: cur.execute("ALTER TABLE students ADD COLUMN image_hash TEXT")
+    if new_rollups: rebuild_rollups()
 
 def register_professor(username, password):
     password_hash = generate_password_hash(password)
@@ -88,16 +187,32 @@ def add_class(pid, name, day, start, end, s_date, e_date, program, year, section
         c.commit()
 
 def edit_class(cid, pid, name, day, start, end, s_date, e_date, program, year, section):
+    # Edits can change the term or the schedule, so bring an archived class back to the hot table;
+    # the next archive pass files it under its (possibly new) term if it is still closed.
+    if get_archive(cid) and get_class_details(cid, pid): unarchive_class(cid)
     with sqlite3.connect(DB) as c:
         c.cursor().execute("UPDATE classes SET name=?, day=?, start_time=?, end_time=?, start_date=?, end_date=?, program=?, year=?, section=? WHERE id=? AND professor_id=?", (name, day, start, end, s_date, e_date, program, year, section, cid, pid))
         c.commit()
+    invalidate_meta()
+    mark_rollups_stale()
 
 def delete_class(cid, pid):
-    with sqlite3.connect(DB) as c:
+    if not get_class_details(cid, pid): return
+    with flush_lock, sqlite3.connect(DB) as c:
+        table = attendance_table(c, cid)
+        discard_pending_attendance(cid)
         c.cursor().execute("DELETE FROM classes WHERE id=? AND professor_id=?", (cid, pid))
         c.cursor().execute("DELETE FROM class_students WHERE class_id=?", (cid,))
-        c.cursor().execute("DELETE FROM attendance WHERE class_id=?", (cid,))
+        c.cursor().execute(f"DELETE FROM {table} WHERE class_id=?", (cid,))
+        c.cursor().execute("DELETE FROM class_cancellations WHERE class_id=?", (cid,))
+        c.cursor().execute("DELETE FROM rollup_student_class WHERE class_id=?", (cid,))
+        c.cursor().execute("DELETE FROM rollup_class_week WHERE class_id=?", (cid,))
+        snapshot = c.cursor().execute("SELECT snapshot FROM attendance_archives WHERE class_id=?", (cid,)).fetchone()
+        c.cursor().execute("DELETE FROM attendance_archives WHERE class_id=?", (cid,))
         c.commit()
+    if snapshot and os.path.exists(os.path.join(ARCHIVE_DIR, snapshot[0])): os.remove(os.path.join(ARCHIVE_DIR, snapshot[0]))
+    invalidate_meta()
+    mark_rollups_stale()
 
 def save_student(sn, ln, fn, mn, yr, prog, sec, suf, encoding=None):
     name = f"{fn} {mn} {ln} {suf}".strip()
@@ -105,13 +220,16 @@ def save_student(sn, ln, fn, mn, yr, prog, sec, suf, encoding=None):
     with sqlite3.connect(DB) as c:
         c.cursor().execute('''INSERT OR REPLACE INTO students (student_number, last_name, first_name, middle_name, year, program, section, suffix, name, encoding) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (sn, ln, fn, mn, yr, prog.upper(), sec, suf, name, enc_blob))
         c.commit()
+    invalidate_meta()
 
 def edit_student(sn, ln, fn, mn, yr, prog, sec, suf):
     name = f"{fn} {mn} {ln} {suf}".strip()
     with sqlite3.connect(DB) as c:
         c.cursor().execute('''UPDATE students SET last_name=?, first_name=?, middle_name=?, year=?, program=?, section=?, suffix=?, name=? WHERE student_number=?''', (ln, fn, mn, yr, prog.upper(), sec, suf, name, sn))
         c.commit()
+    invalidate_meta()
 
+@timed("db_query_seconds", op="get_all_encodings")
 def get_all_encodings():
     with sqlite3.connect(DB) as c:
         rows = c.cursor().execute("SELECT student_number, name, encoding FROM students WHERE encoding IS NOT NULL").fetchall()
@@ -123,18 +241,23 @@ def get_all_encodings():
             encs.append(np.frombuffer(blob, dtype=np.float64))
     return ids, names, encs
 
+@timed("db_query_seconds", op="get_all_professor_classes")
 def get_all_professor_classes(pid):
     with sqlite3.connect(DB) as c:
         return c.cursor().execute("SELECT id, name, day, start_time, end_time, section, program, year, start_date, end_date FROM classes WHERE professor_id=?", (pid,)).fetchall()
 
 def get_classes_by_day(pid, day):
     with sqlite3.connect(DB) as c:
-        return c.cursor().execute("SELECT id, name, start_time, end_time, section FROM classes WHERE professor_id=? AND day=?", (pid, day)).fetchall()
+        rows = c.cursor().execute("SELECT id, name, start_time, end_time, section, day FROM classes WHERE professor_id=?", (pid,)).fetchall()
+    wd = DAY_NAMES.index(day)
+    return [r[:5] for r in rows if wd in parse_days(r[5])]
 
+@timed("db_query_seconds", op="get_class_details")
 def get_class_details(cid, pid):
     with sqlite3.connect(DB) as c:
         return c.cursor().execute("SELECT name, start_time, end_time, day, program, year, section, start_date, end_date FROM classes WHERE id=? AND professor_id=?", (cid, pid)).fetchone()
 
+@timed("db_query_seconds", op="count_all_students")
 def count_all_students(year=None, program=None, section=None, search_type=None, search_val=None, is_irregular=False):
     with sqlite3.connect(DB) as c:
         query = "SELECT COUNT(*) FROM students"
@@ -150,6 +273,7 @@ def count_all_students(year=None, program=None, section=None, search_type=None,
         if conds: query += " WHERE " + " AND ".join(conds)
         return c.cursor().execute(query, params).fetchone()[0]
 
+@timed("db_query_seconds", op="get_all_students")
 def get_all_students(year=None, program=None, section=None, search_type=None, search_val=None, is_irregular=False, offset=0, limit=None):
     with sqlite3.connect(DB) as c:
         query = "SELECT student_number, first_name, last_name, year, program, section, middle_name, suffix, (encoding IS NOT NULL) FROM students"
@@ -171,6 +295,8 @@ def add_students_to_class(cid, sns):
     with sqlite3.connect(DB) as c:
         for sn in sns: c.cursor().execute("INSERT OR IGNORE INTO class_students (class_id, student_number) VALUES (?, ?)", (cid, sn))
         c.commit()
+    invalidate_meta()
+    mark_rollups_stale()
 
 def import_section_students(cid):
     with sqlite3.connect(DB) as c:
@@ -183,14 +309,23 @@ def import_section_students(cid):
             c.cursor().execute("INSERT OR IGNORE INTO class_students (class_id, student_number) VALUES (?, ?)", (cid, s[0]))
             count += 1
         c.commit()
-        return count
+    invalidate_meta()
+    mark_rollups_stale()
+    return count
 
 def remove_student_from_class(cid, sn):
-    with sqlite3.connect(DB) as c:
+    with flush_lock, sqlite3.connect(DB) as c:
+        table = attendance_table(c, cid)
+        discard_pending_attendance(cid, sn)
         c.cursor().execute("DELETE FROM class_students WHERE class_id=? AND student_number=?", (cid, sn))
-        c.cursor().execute("DELETE FROM attendance WHERE class_id=? AND student_number=?", (cid, sn))
+        _delete_attendance(c.cursor(), table, cid, "student_number=?", (sn,))
+        c.cursor().execute("DELETE FROM rollup_student_class WHERE class_id=? AND student_number=?", (cid, sn))
         c.commit()
+    invalidate_meta()
+    mark_rollups_stale()
+    if get_archive(cid): write_snapshot(cid)
 
+@timed("db_query_seconds", op="get_class_students_with_details")
 def get_class_students_with_details(cid):
     with sqlite3.connect(DB) as c:
         return c.cursor().execute('''
@@ -200,28 +335,148 @@ def get_class_students_with_details(cid):
             WHERE cs.class_id=? 
             ORDER BY s.last_name, s.first_name''', (cid,)).fetchall()
 
-def log_attendance(cid, sn, status, specific_date=None):
+def _attendance_timestamp(specific_date=None):
     if specific_date:
-        ts = f"{specific_date} {datetime.now().strftime('%H:%M:%S')}"
-    else:
-        ts = time.strftime("%Y-%m-%d %H:%M:%S")
-        
+        # Raises ValueError for anything but YYYY-MM-DD so a bad date never reaches the buffer
+        datetime.strptime(specific_date, "%Y-%m-%d")
+        return f"{specific_date} {datetime.now().strftime('%H:%M:%S')}"
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+def _write_attendance(cur, cid, sn, ts, status):
+    """Upserts the single attendance row a student has per class per day and keeps the rollups in step."""
     today = ts.split(" ")[0]
-    
-    with sqlite3.connect(DB) as c:
-        existing = c.cursor().execute("SELECT * FROM attendance WHERE class_id=? AND student_number=? AND timestamp LIKE ?", (cid, sn, f"{today}%")).fetchone()
-        if existing:
-            c.cursor().execute("UPDATE attendance SET timestamp=?, status=? WHERE class_id=? AND student_number=? AND timestamp LIKE ?", (ts, status, cid, sn, f"{today}%"))
-            c.commit()
-        else:
-            c.cursor().execute("INSERT INTO attendance (class_id, student_number, timestamp, status) VALUES (?, ?, ?, ?)", (cid, sn, ts, status))
-            c.commit()
+    day_range = (f"{today} 00:00:00", f"{today} 23:59:59")
+    old = cur.execute("SELECT status FROM attendance WHERE class_id=? AND student_number=? AND timestamp BETWEEN ? AND ?", (cid, sn, *day_range)).fetchone()
+    if old:
+        cur.execute("UPDATE attendance SET timestamp=?, status=? WHERE class_id=? AND student_number=? AND timestamp BETWEEN ? AND ?", (ts, status, cid, sn, *day_range))
+        _bump_rollups(cur, cid, sn, today, old[0], -1)
+    else:
+        cur.execute("INSERT INTO attendance (class_id, student_number, timestamp, status) VALUES (?, ?, ?, ?)", (cid, sn, ts, status))
+    _bump_rollups(cur, cid, sn, today, status, 1)
+
+def _archived_among(cur, cids):
+    """Class ids in `cids` whose term is archived. Checked inside the write transaction, because another
+    worker may have archived a class since this process cached get_archive()."""
+    cids = list(cids)
+    return {r[0] for r in cur.execute(f"SELECT class_id FROM attendance_archives WHERE class_id IN ({','.join('?' * len(cids))})", cids).fetchall()}
+
+def _drop_archived_marks(cids):
+    print(f"Dropped attendance marks for archived classes {sorted(cids)}")
+    with meta_lock:
+        for cid in cids: meta_cache.pop(('archive', cid), None)
+
+# --- Write-behind attendance buffer ---
+def queue_attendance(cid, sn, status, specific_date=None):
+    """Buffers an attendance mark in memory; repeat sightings on the same day collapse into one pending write."""
+    ts = _attendance_timestamp(specific_date)
+    cid = int(cid)
+    with attendance_lock:
+        pending_attendance[(cid, sn, ts.split(" ")[0])] = (ts, status)
+    start_attendance_flusher()
+
+def flush_attendance():
+    """Writes every pending attendance mark in a single transaction."""
+    with flush_lock:
+        with attendance_lock:
+            if not pending_attendance: return 0
+            batch = dict(pending_attendance)
+            pending_attendance.clear()
+            inflight_attendance.update(batch)
+        try:
+            with span("db_query_seconds", op="flush_attendance"), sqlite3.connect(DB) as c:
+                cur = c.cursor()
+                cur.execute("BEGIN IMMEDIATE")
+                archived = _archived_among(cur, {k[0] for k in batch})
+                for (cid, sn, _), (ts, status) in batch.items():
+                    if cid not in archived: _write_attendance(cur, cid, sn, ts, status)
+                c.commit()
+            metrics.inc("attendance_flushed_total", len(batch))
+            if archived: _drop_archived_marks(archived)
+        except Exception as e:
+            # Put the batch back so the next flush retries it; newer marks for the same key win
+            print(f"Error flushing attendance: {e}")
+            with attendance_lock:
+                for key, val in batch.items(): pending_attendance.setdefault(key, val)
+            return 0
+        finally:
+            with attendance_lock: inflight_attendance.clear()
+        return len(batch)
+
+def pending_marks(cid, date=None):
+    """Returns {(student_number, date): (timestamp, status)} for marks of a class not yet committed.
+    Reads overlay these on the database instead of forcing a flush; take them before querying."""
+    cid = int(cid)
+    with attendance_lock:
+        return {(k[1], k[2]): v for src in (inflight_attendance, pending_attendance) for k, v in src.items()
+                if k[0] == cid and date in (None, k[2])}
+
+def discard_pending_attendance(cid, sn=None, date=None):
+    """Drops buffered marks that a delete is about to remove. Caller must hold flush_lock."""
+    cid = int(cid)
+    with attendance_lock:
+        for key in [k for k in pending_attendance if k[0] == cid and sn in (None, k[1]) and date in (None, k[2])]:
+            del pending_attendance[key]
+
+def _attendance_flush_loop():
+    while True:
+        time.sleep(ATTENDANCE_FLUSH_MS / 1000)
+        try: flush_attendance()
+        except Exception as e: print(f"Error in attendance flusher: {e}")
+
+def start_attendance_flusher():
+    global attendance_flusher
+    if attendance_flusher is not None: return
+    with attendance_lock:
+        if attendance_flusher is None:
+            attendance_flusher = threading.Thread(target=_attendance_flush_loop, daemon=True)
+            attendance_flusher.start()
+
+atexit.register(flush_attendance)
+
+# --- Metadata cache ---
+def _cached_meta(key, loader):
+    # Entries expire so edits made by another worker process show up within META_CACHE_TTL
+    now = time.monotonic()
+    with meta_lock:
+        hit = meta_cache.get(key)
+        if hit and hit[0] > now: return hit[1]
+    val = loader()
+    with meta_lock: meta_cache[key] = (now + META_CACHE_TTL, val)
+    return val
+
+def invalidate_meta():
+    with meta_lock: meta_cache.clear()
+
+def get_class_meta(cid):
+    """Returns (start_time, name, section) for a class, or None."""
+    def load():
+        with sqlite3.connect(DB) as c:
+            return c.cursor().execute("SELECT start_time, name, section FROM classes WHERE id=?", (cid,)).fetchone()
+    return _cached_meta(('class', cid), load)
+
+def get_student_meta(sn):
+    """Returns (last_name, first_name) for a student, or None."""
+    def load():
+        with sqlite3.connect(DB) as c:
+            return c.cursor().execute("SELECT last_name, first_name FROM students WHERE student_number=?", (sn,)).fetchone()
+    return _cached_meta(('student', sn), load)
 
+def get_class_roster(cid):
+    def load():
+        with sqlite3.connect(DB) as c:
+            return frozenset(r[0] for r in c.cursor().execute("SELECT student_number FROM class_students WHERE class_id=?", (cid,)).fetchall())
+    return _cached_meta(('roster', cid), load)
+
+@timed("db_query_seconds", op="get_attendance_by_date")
 def get_attendance_by_date(cid, target_date):
     if not target_date: target_date = datetime.now().strftime("%Y-%m-%d")
+    pending = pending_marks(cid, target_date)
     with sqlite3.connect(DB) as c:
-        rows = c.cursor().execute("SELECT student_number, status FROM attendance WHERE class_id=? AND timestamp LIKE ?", (cid, f"{target_date}%")).fetchall()
-    return {r[0]: r[1] for r in rows}
+        table = attendance_table(c, cid)
+        rows = c.cursor().execute(f"SELECT student_number, status FROM {table} WHERE class_id=? AND timestamp BETWEEN ? AND ?", (cid, f"{target_date} 00:00:00", f"{target_date} 23:59:59")).fetchall()
+    out = {r[0]: r[1] for r in rows}
+    out.update({sn: status for (sn, _), (_, status) in pending.items()})
+    return out
 
 def get_student_statuses(cid, target_date=None):
     students = get_class_students_with_details(cid)
@@ -235,55 +490,609 @@ def get_student_statuses(cid, target_date=None):
         results[sn] = {'name': formatted_name, 'section': section, 'status': status}
     return results
 
+def is_valid_date(date_str):
+    try: return bool(datetime.strptime(date_str, "%Y-%m-%d"))
+    except (TypeError, ValueError): return False
+
 def compute_status(start, ts):
     s_dt = datetime.strptime(start, "%H:%M")
     t_dt = datetime.strptime(ts.split(" ")[1], "%H:%M:%S")
     return "on_time" if t_dt <= s_dt + timedelta(minutes=LATE_THRESHOLD) else "late"
 
-# --- HELPER: Generate all dates for a class ---
-def get_class_dates(day_name, start_date_str, end_date_str):
-    """Generates all dates for a class between start and end date (or today)."""
-    dates = []
+# ================= SCHEDULE ENGINE =================
+DAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+DAY_CODES = {"m": 0, "t": 1, "tu": 1, "w": 2, "th": 3, "r": 3, "f": 4, "s": 5, "sa": 5, "su": 6}
+
+def parse_days(day):
+    """Parses a class day pattern into sorted weekday numbers.
+    Accepts full or short names separated by commas/slashes/spaces ("Monday,Wednesday", "Tue/Thu")
+    and compact codes ("MWF", "TTh", "TuTh", "TR", "SaSu"). Returns () if any token is not a day."""
+    days = set()
+    for token in re.split(r"[\s,/]+", (day or "").strip().lower()):
+        if not token: continue
+        named = [i for i, n in enumerate(DAY_NAMES) if len(token) >= 3 and n.lower().startswith(token)]
+        if named:
+            days.add(named[0])
+            continue
+        codes = re.findall(r"th|tu|su|sa|m|t|w|r|f|s", token)
+        if "".join(codes) != token: return ()
+        days.update(DAY_CODES[code] for code in codes)
+    return tuple(sorted(days))
+
+def format_days(day):
+    return ",".join(DAY_NAMES[wd] for wd in parse_days(day))
+
+def meeting_dates(day, start_date_str, end_date_str, skip=()):
+    """Computes every meeting date of a weekly pattern between start and end date (inclusive),
+    stepping a week at a time from the first occurrence of each weekday."""
     try:
         start = datetime.strptime(start_date_str, "%Y-%m-%d").date()
         end = datetime.strptime(end_date_str, "%Y-%m-%d").date()
-        today = datetime.now().date()
-        limit = min(end, today)
-        
-        target_weekday = time.strptime(day_name, "%A").tm_wday
-        
-        curr = start
-        while curr <= limit:
-            if curr.weekday() == target_weekday:
-                dates.append(curr.strftime("%Y-%m-%d"))
-            curr += timedelta(days=1)
-    except Exception as e:
+    except (TypeError, ValueError) as e:
         print(f"Error generating dates: {e}")
-    return dates
-
-def find_nearest_class_date(day_name, start_date_str, end_date_str):
+        return []
+    dates = []
+    for wd in parse_days(day):
+        first = start + timedelta(days=(wd - start.weekday()) % 7)
+        if first > end: continue
+        dates.extend(first + timedelta(weeks=i) for i in range((end - first).days // 7 + 1))
+    return [d for d in (d.strftime("%Y-%m-%d") for d in sorted(dates)) if d not in skip]
+
+def count_meetings(day, start_date_str, end_date_str, skip=()):
+    """Number of meetings meeting_dates() would return, without building the list."""
     try:
         start = datetime.strptime(start_date_str, "%Y-%m-%d").date()
         end = datetime.strptime(end_date_str, "%Y-%m-%d").date()
-        today = datetime.now().date()
-        target_weekday = time.strptime(day_name, "%A").tm_wday
-        delta = timedelta(days=1)
-        candidates = []
-        curr = start
-        while curr <= end:
-            if curr.weekday() == target_weekday:
-                candidates.append(curr)
-            curr += delta
-        if not candidates:
-            return None
-        closest = min(candidates, key=lambda d: abs((d - today).days))
-        return closest.strftime("%Y-%m-%d")
-    except:
-        return None
+    except (TypeError, ValueError):
+        return 0
+    days = parse_days(day)
+    n = 0
+    for wd in days:
+        first = start + timedelta(days=(wd - start.weekday()) % 7)
+        if first <= end: n += (end - first).days // 7 + 1
+    for d in skip:
+        if not start_date_str <= d <= end_date_str: continue
+        try: wd = datetime.strptime(d, "%Y-%m-%d").weekday()
+        except ValueError: continue  # malformed holiday/cancellation row; it can't fall on a meeting anyway
+        if wd in days: n -= 1
+    return n
+
+@timed("db_query_seconds", op="get_class_schedule")
+def get_class_schedule(cid):
+    """Returns the full term's meeting dates for a class, minus holidays and cancelled sessions."""
+    def load():
+        with sqlite3.connect(DB) as c:
+            cls = c.cursor().execute("SELECT day, start_date, end_date FROM classes WHERE id=?", (cid,)).fetchone()
+            if not cls: return ()
+            skip = {r[0] for r in c.cursor().execute("SELECT date FROM holidays WHERE date BETWEEN ? AND ?", (cls[1], cls[2])).fetchall()}
+            skip.update(r[0] for r in c.cursor().execute("SELECT date FROM class_cancellations WHERE class_id=?", (cid,)).fetchall())
+        return tuple(meeting_dates(cls[0], cls[1], cls[2], skip))
+    return _cached_meta(('schedule', int(cid)), load)
+
+def get_class_dates(cid):
+    """Meeting dates that have already happened (up to today)."""
+    schedule = get_class_schedule(cid)
+    return list(schedule[:bisect.bisect_right(schedule, datetime.now().strftime("%Y-%m-%d"))])
+
+def is_class_date(cid, date_str):
+    schedule = get_class_schedule(cid)
+    i = bisect.bisect_left(schedule, date_str)
+    return i < len(schedule) and schedule[i] == date_str
+
+def find_nearest_class_date(cid):
+    schedule = get_class_schedule(cid)
+    if not schedule: return None
+    today = datetime.now().strftime("%Y-%m-%d")
+    i = bisect.bisect_left(schedule, today)
+    candidates = schedule[max(i - 1, 0):i + 1]
+    t = datetime.strptime(today, "%Y-%m-%d")
+    return min(candidates, key=lambda d: abs((datetime.strptime(d, "%Y-%m-%d") - t).days))
+
+@app.template_filter("day_names")
+def day_names_filter(day):
+    return format_days(day)
+
+# ================= ANALYTICS =================
+# Rollups hold on-time/late counts per (class, student), per student and per (class, ISO week). They are
+# adjusted in the same transaction as every attendance write or delete, so analytics never scan the
+# attendance history. Absences are derived from the number of meetings held so far (schedule engine).
+# rollup_student also carries each student's total sessions and rate; those depend on the date, rosters
+# and schedules, so the table is rebuilt from the per-class rollups once a day or after such a change.
+# Marks still in the write-behind buffer are counted once the flusher commits them (ATTENDANCE_FLUSH_MS).
+AT_RISK_THRESHOLD = 75.0
+
+def _iso_week(day):
+    """ISO week ("2026-W33") of a YYYY-MM-DD date, or None for a malformed legacy date so bookkeeping never raises."""
+    try: return datetime.strptime(day, "%Y-%m-%d").strftime("%G-W%V")
+    except ValueError: return None
+
+def _bump_rollups(cur, cid, sn, day, status, delta):
+    if status not in ("on_time", "late"): return
+    col = status
+    week = _iso_week(day)
+    cur.execute(f'''INSERT INTO rollup_student_class (class_id, student_number, on_time, late) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (class_id, student_number) DO UPDATE SET {col} = {col} + ?''',
+                (cid, sn, delta if col == "on_time" else 0, delta if col == "late" else 0, delta))
+    if week:
+        cur.execute(f'''INSERT INTO rollup_class_week (class_id, week, on_time, late) VALUES (?, ?, ?, ?)
+                        ON CONFLICT (class_id, week) DO UPDATE SET {col} = {col} + ?''',
+                    (cid, week, delta if col == "on_time" else 0, delta if col == "late" else 0, delta))
+    cur.execute(f"UPDATE rollup_student SET {col} = {col} + ?, rate = CASE WHEN sessions > 0 THEN MIN(100.0, 100.0 * (on_time + late + ?) / sessions) END WHERE student_number=?", (delta, delta, sn))
+
+def _delete_attendance(cur, table, cid, where, params):
+    """Deletes a class's attendance rows matching `where` and takes them out of the rollups."""
+    for sn, ts, status in cur.execute(f"SELECT student_number, timestamp, status FROM {table} WHERE class_id=? AND {where}", (cid, *params)).fetchall():
+        _bump_rollups(cur, cid, sn, ts.split(" ")[0], status, -1)
+    cur.execute(f"DELETE FROM {table} WHERE class_id=? AND {where}", (cid, *params))
+
+def rebuild_rollups():
+    """Recomputes every rollup from the live table and all term archives."""
+    with sqlite3.connect(DB) as c:
+        archives = [r[0] for r in c.execute("SELECT DISTINCT path FROM attendance_archives").fetchall()]
+        tables = ["attendance"] + [f"{attach_term(c, path)}.attendance" for path in archives]
+        c.execute("DELETE FROM rollup_student_class")
+        c.execute("DELETE FROM rollup_class_week")
+        c.execute("DELETE FROM rollup_meta WHERE key='students_as_of'")
+        for table in tables:
+            c.execute(f'''INSERT INTO rollup_student_class (class_id, student_number, on_time, late)
+                          SELECT class_id, student_number, SUM(status = 'on_time'), SUM(status = 'late') FROM {table} WHERE true GROUP BY class_id, student_number
+                          ON CONFLICT (class_id, student_number) DO UPDATE SET on_time = on_time + excluded.on_time, late = late + excluded.late''')
+            weeks = {}
+            for cid, day, status in c.execute(f"SELECT class_id, substr(timestamp, 1, 10), status FROM {table} WHERE status IN ('on_time', 'late')").fetchall():
+                week = _iso_week(day)
+                if not week: continue
+                counts = weeks.setdefault((cid, week), [0, 0])
+                counts[status == "late"] += 1
+            c.executemany('''INSERT INTO rollup_class_week (class_id, week, on_time, late) VALUES (?, ?, ?, ?)
+                             ON CONFLICT (class_id, week) DO UPDATE SET on_time = on_time + excluded.on_time, late = late + excluded.late''',
+                          [(cid, week, n[0], n[1]) for (cid, week), n in weeks.items()])
+        c.commit()
+
+def _count_held(c, today):
+    classes = c.execute("SELECT id, day, start_date, end_date FROM classes").fetchall()
+    holidays = [r[0] for r in c.execute("SELECT date FROM holidays").fetchall()]
+    cancelled = {}
+    for cid, date in c.execute("SELECT class_id, date FROM class_cancellations").fetchall(): cancelled.setdefault(cid, set()).add(date)
+    return {cid: count_meetings(day, s_date, min(e_date or "", today), cancelled.get(cid, set()).union(holidays)) for cid, day, s_date, e_date in classes}
+
+def held_session_counts():
+    """Returns {class_id: meetings held up to today} for every class, computed arithmetically and cached."""
+    today = datetime.now().strftime("%Y-%m-%d")
+    def load():
+        with sqlite3.connect(DB) as c: return _count_held(c, today)
+    return _cached_meta(('held', today), load)
+
+def _with_held(c, fresh=False):
+    """Fills temp.held on `c`; `fresh` reads the counts through `c` itself instead of the per-process cache."""
+    held = _count_held(c, datetime.now().strftime("%Y-%m-%d")) if fresh else held_session_counts()
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS held (class_id INTEGER PRIMARY KEY, n INTEGER)")
+    c.execute("DELETE FROM temp.held")
+    c.executemany("INSERT INTO temp.held (class_id, n) VALUES (?, ?)", held.items())
+
+def mark_rollups_stale():
+    """Forces the next analytics query to recompute per-student sessions (rosters or schedules changed).
+    Bumps a generation counter rather than clearing a flag, so a rebuild already under way can't mark
+    itself current over this change."""
+    with sqlite3.connect(DB) as c:
+        c.execute("INSERT INTO rollup_meta (key, value) VALUES ('generation', 1) ON CONFLICT (key) DO UPDATE SET value = value + 1")
+        c.commit()
+
+def _rollup_version(c, today):
+    meta = dict(c.execute("SELECT key, value FROM rollup_meta WHERE key IN ('generation', 'students_as_of')").fetchall())
+    return f"{today}/{meta.get('generation', 0)}", meta.get("students_as_of")
+
+def refresh_student_rollups():
+    """Rebuilds rollup_student from the per-class rollups unless it is current for today and the latest generation."""
+    today = datetime.now().strftime("%Y-%m-%d")
+    with sqlite3.connect(DB) as c:
+        want, have = _rollup_version(c, today)
+        if want == have: return
+        # Check again and rebuild under the write lock, with session counts read in the same transaction:
+        # another worker's cached counts may predate the edit that bumped the generation.
+        c.execute("BEGIN IMMEDIATE")
+        want, have = _rollup_version(c, today)
+        if want == have:
+            c.commit()
+            return
+        _with_held(c, fresh=True)
+        c.execute("DELETE FROM rollup_student")
+        c.execute('''INSERT INTO rollup_student (student_number, classes, sessions, on_time, late, rate)
+                     SELECT cs.student_number, COUNT(*), SUM(h.n), SUM(COALESCE(r.on_time, 0)), SUM(COALESCE(r.late, 0)),
+                            CASE WHEN SUM(h.n) > 0 THEN MIN(100.0, 100.0 * SUM(COALESCE(r.on_time, 0) + COALESCE(r.late, 0)) / SUM(h.n)) END
+                     FROM (SELECT DISTINCT class_id, student_number FROM class_students) cs
+                     JOIN temp.held h ON h.class_id = cs.class_id
+                     LEFT JOIN rollup_student_class r ON r.class_id = cs.class_id AND r.student_number = cs.student_number
+                     GROUP BY cs.student_number''')
+        c.execute("INSERT OR REPLACE INTO rollup_meta (key, value) VALUES ('students_as_of', ?)", (want,))
+        c.commit()
+
+def student_rates(below=None, year=None, program=None, section=None, offset=0, limit=50):
+    """Attendance rate per student across all enrolled classes, lowest first; optionally only those below `below` %."""
+    with span("db_query_seconds", op="refresh_student_rollups"):
+        refresh_student_rollups()
+    with sqlite3.connect(DB) as c:
+        query = '''SELECT s.student_number, s.last_name, s.first_name, s.program, s.year, s.section, r.classes, r.sessions, r.on_time, r.late, r.rate
+                   FROM rollup_student r JOIN students s ON s.student_number = r.student_number'''
+        params, conds = [], []
+        if below is not None: conds.append("r.rate < ?"), params.append(below)
+        if year: conds.append("s.year=?"), params.append(year)
+        if program: conds.append("s.program=?"), params.append(program.upper())
+        if section: conds.append("s.section LIKE ?"), params.append(f"%{section}%")
+        if conds: query += " WHERE " + " AND ".join(conds)
+        query += " ORDER BY r.rate IS NULL, r.rate, s.last_name, s.first_name LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        rows = c.execute(query, params).fetchall()
+    return [{"student_number": r[0], "last_name": r[1], "first_name": r[2], "program": r[3], "year": r[4], "section": r[5],
+             "classes": r[6], "sessions": r[7], "present": r[8], "late": r[9], "absent": max(r[7] - r[8] - r[9], 0),
+             "rate": round(r[10], 2) if r[10] is not None else None} for r in rows]
+
+def student_class_rates(sn):
+    """Per-class breakdown for one student."""
+    with sqlite3.connect(DB) as c:
+        _with_held(c)
+        rows = c.execute('''SELECT cl.id, cl.name, cl.section, h.n, COALESCE(r.on_time, 0), COALESCE(r.late, 0)
+                            FROM (SELECT DISTINCT class_id, student_number FROM class_students WHERE student_number=?) cs
+                            JOIN classes cl ON cl.id = cs.class_id
+                            JOIN temp.held h ON h.class_id = cs.class_id
+                            LEFT JOIN rollup_student_class r ON r.class_id = cs.class_id AND r.student_number = cs.student_number
+                            ORDER BY cl.name''', (sn,)).fetchall()
+    return [{"class_id": r[0], "name": r[1], "section": r[2], "sessions": r[3], "present": r[4], "late": r[5],
+             "absent": max(r[3] - r[4] - r[5], 0), "rate": round(min(100.0, 100.0 * (r[4] + r[5]) / r[3]), 2) if r[3] else None} for r in rows]
+
+def class_weekly_rates(cid):
+    """Per-ISO-week on-time/late counts for a class, with meetings held and the enrolled headcount."""
+    held = {}
+    for d in get_class_dates(cid):
+        week = datetime.strptime(d, "%Y-%m-%d").strftime("%G-W%V")
+        held[week] = held.get(week, 0) + 1
+    enrolled = len(get_class_roster(cid))
+    with sqlite3.connect(DB) as c:
+        counts = {r[0]: (r[1], r[2]) for r in c.execute("SELECT week, on_time, late FROM rollup_class_week WHERE class_id=?", (cid,)).fetchall()}
+    out = []
+    for week in sorted(set(held) | set(counts)):
+        on_time, late = counts.get(week, (0, 0))
+        expected = held.get(week, 0) * enrolled
+        out.append({"week": week, "sessions": held.get(week, 0), "present": on_time, "late": late,
+                    "rate": round(min(100.0, 100.0 * (on_time + late) / expected), 2) if expected else None})
+    return out
+
+# ================= IMAGE STORE =================
+# Enrollment photos are stored once under their SHA-256 (student_images/<ab>/<hash>.jpg) and referenced by
+# students.image_hash, which is set together with the encoding. Files are written on a background thread so
+# requests never wait on disk; photos still in the queue are served from memory. A replaced photo's file is
+# deleted once nothing references it. Thumbnails are generated on demand and kept in an in-memory LRU.
+image_queue = queue.Queue()
+pending_images = {}  # hash -> JPEG bytes not yet on disk
+images_lock = threading.Lock()
+image_writer = None
+thumb_cache = OrderedDict()  # (hash, size) -> JPEG bytes
+thumb_lock = threading.Lock()
+thumb_cache_bytes = 0
+reencode_status = {"running": False, "total": 0, "done": 0, "updated": 0, "failed": 0, "started_at": None, "finished_at": None}
+
+def image_path(h):
+    return os.path.join(UPLOADS, h[:2], f"{h}.jpg")
+
+def image_source(sn):
+    """Returns (hash, loader for the JPEG bytes) for a student's photo, or None if there is none.
+    The hash is None for a legacy <sn>.jpg that has not been moved into the store yet."""
+    with sqlite3.connect(DB) as c:
+        row = c.cursor().execute("SELECT image_hash FROM students WHERE student_number=?", (sn,)).fetchone()
+    if row is None: return None
+    h = row[0]
+    if h:
+        with images_lock: jpeg = pending_images.get(h)
+        if jpeg is not None: return h, lambda: jpeg
+    for key, path in ([(h, image_path(h))] if h else []) + [(None, os.path.join(UPLOADS, f"{sn}.jpg"))]:
+        if os.path.exists(path):
+            def load(path=path):
+                with open(path, "rb") as f: return f.read()
+            return key, load
+    return None
+
+def store_image(sn, jpeg, encoding=None):
+    """Records `jpeg` as a student's photo (with its face encoding, if given) and queues the file write.
+    Without an encoding it only adopts the photo for a student who has none in the store yet (legacy
+    <sn>.jpg). The files it supersedes, the previous photo and any legacy <sn>.jpg, are deleted once the
+    new one is on disk. Returns the photo's hash."""
+    h = hashlib.sha256(jpeg).hexdigest()
+    with images_lock: pending_images[h] = jpeg
+    with sqlite3.connect(DB) as c:
+        cur = c.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        old = cur.execute("SELECT image_hash FROM students WHERE student_number=?", (sn,)).fetchone()
+        if encoding is not None: cur.execute("UPDATE students SET encoding=?, image_hash=? WHERE student_number=?", (encoding, h, sn))
+        else: cur.execute("UPDATE students SET image_hash=? WHERE student_number=? AND image_hash IS NULL", (h, sn))
+        stored = cur.rowcount
+        c.commit()
+    if not stored:
+        # Unknown student, or a new photo landed first: nothing references this one, so don't write it
+        with images_lock: pending_images.pop(h, None)
+        return h
+    image_queue.put((h, old[0] if old and old[0] != h else None, os.path.join(UPLOADS, f"{sn}.jpg")))
+    start_image_writer()
+    return h
+
+def _write_image(h, replaced, legacy):
+    with images_lock: jpeg = pending_images.get(h)
+    if jpeg is None: return
+    path = image_path(h)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f: f.write(jpeg)
+        os.replace(tmp, path)
+    with images_lock: pending_images.pop(h, None)
+    if os.path.exists(legacy): os.remove(legacy)
+    if replaced:
+        # Content-addressed files can be shared by students with identical photos
+        with sqlite3.connect(DB) as c:
+            in_use = c.cursor().execute("SELECT 1 FROM students WHERE image_hash=? LIMIT 1", (replaced,)).fetchone()
+        with images_lock: in_use = in_use or replaced in pending_images
+        if not in_use and os.path.exists(image_path(replaced)): os.remove(image_path(replaced))
+
+def _image_writer_loop():
+    while True:
+        h, replaced, legacy = image_queue.get()
+        try:
+            with span("image_write_seconds"): _write_image(h, replaced, legacy)
+        except Exception as e:
+            print(f"Error storing image {h}: {e}")
+        finally:
+            image_queue.task_done()
+
+def start_image_writer():
+    global image_writer
+    if image_writer is not None: return
+    with images_lock:
+        if image_writer is None:
+            image_writer = threading.Thread(target=_image_writer_loop, daemon=True)
+            image_writer.start()
+
+def flush_images():
+    """Blocks until every queued photo is on disk."""
+    if image_writer is not None: image_queue.join()
+
+atexit.register(flush_images)
+
+def get_thumbnail(sn, size):
+    """Returns (etag, JPEG bytes) of a student's photo scaled to fit `size` pixels, or None."""
+    global thumb_cache_bytes
+    src = image_source(sn)
+    if src is None: return None
+    h, load = src
+    jpeg = None
+    if h is None:
+        jpeg = load()
+        h = store_image(sn, jpeg)
+    key = (h, size)
+    with thumb_lock:
+        if key in thumb_cache:
+            thumb_cache.move_to_end(key)
+            return f"{h}-{size}", thumb_cache[key]
+    load_imaging()
+    with span("thumbnail_seconds"):
+        img = cv2.imdecode(np.frombuffer(jpeg if jpeg is not None else load(), np.uint8), cv2.IMREAD_COLOR)
+        if img is None: return None
+        scale = size / max(img.shape[:2])
+        if scale < 1: img = cv2.resize(img, (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+        thumb = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes()
+    with thumb_lock:
+        if key not in thumb_cache:
+            thumb_cache[key] = thumb
+            thumb_cache_bytes += len(thumb)
+        while thumb_cache_bytes > THUMB_CACHE_BYTES and thumb_cache:
+            thumb_cache_bytes -= len(thumb_cache.popitem(last=False)[1])
+    return f"{h}-{size}", thumb
+
+def _encode_image_file(args):
+    """Worker for reencode_faces(); runs in a child process."""
+    sn, h, path, model, jitters = args
+    import face_recognition as fr
+    try:
+        img = fr.load_image_file(path)
+        locations = fr.face_locations(img, model=model)
+        if len(locations) != 1: return sn, h, None
+        return sn, h, fr.face_encodings(img, locations, num_jitters=jitters)[0].tobytes()
+    except Exception:
+        return sn, h, None
+
+def reencode_faces():
+    """Recomputes every stored encoding from its original photo with the current recognition settings."""
+    flush_images()
+    with sqlite3.connect(DB) as c:
+        rows = c.cursor().execute("SELECT student_number, image_hash FROM students").fetchall()
+    jobs = []
+    for sn, h in rows:
+        for path in ([image_path(h)] if h else []) + [os.path.join(UPLOADS, f"{sn}.jpg")]:
+            if os.path.exists(path):
+                jobs.append((sn, h, path, FACE_DETECTION_MODEL, FACE_NUM_JITTERS))
+                break
+    reencode_status.update(total=len(jobs), done=0, updated=0, failed=0, started_at=time.strftime("%Y-%m-%d %H:%M:%S"), finished_at=None)
+    updates = []
+    # Spawn rather than fork: forking a process that already runs server threads can deadlock the child
+    with ProcessPoolExecutor(max_workers=REENCODE_WORKERS, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for sn, h, enc in pool.map(_encode_image_file, jobs, chunksize=8):
+            reencode_status["done"] += 1
+            if enc is None: reencode_status["failed"] += 1
+            else: updates.append((enc, sn, h))
+            if len(updates) >= 100:
+                _save_encodings(updates)
+                updates = []
+    _save_encodings(updates)
+    reencode_status.update(running=False, finished_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+
+def _save_encodings(updates):
+    if not updates: return
+    with sqlite3.connect(DB) as c:
+        # Skip students whose photo changed while the job ran; their new encoding is already current
+        cur = c.cursor()
+        cur.executemany("UPDATE students SET encoding=? WHERE student_number=? AND image_hash IS ?", updates)
+        c.commit()
+    reencode_status["updated"] += cur.rowcount
+
+def start_reencode():
+    with images_lock:
+        if reencode_status["running"]: return False
+        reencode_status["running"] = True
+    def run():
+        try: reencode_faces()
+        except Exception as e:
+            print(f"Error re-encoding faces: {e}")
+            reencode_status.update(running=False, finished_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+# ================= TERM ARCHIVES =================
+# A class's term closes after its end_date. Closed classes have their attendance moved out of the hot
+# table into one SQLite file per term (attached on demand) plus a compact per-class snapshot that
+# historical exports read without touching the live database.
+COURSE_FIELDS = ("name", "day", "start_date", "end_date", "start_time", "end_time", "section", "program", "year")
+
+def get_archive(cid):
+    """Returns (term, archive file, snapshot file) for an archived class, or None."""
+    def load():
+        with sqlite3.connect(DB) as c:
+            return c.cursor().execute("SELECT term, path, snapshot FROM attendance_archives WHERE class_id=?", (cid,)).fetchone()
+    return _cached_meta(('archive', int(cid)), load)
+
+def attach_term(c, path, create=False):
+    """Attaches a term archive to connection `c` (once) and returns its schema alias.
+    Must be called before the connection starts a write transaction."""
+    alias = "term_" + re.sub(r"\W", "_", os.path.splitext(path)[0])
+    if alias not in [r[1] for r in c.execute("PRAGMA database_list").fetchall()]:
+        c.execute(f"ATTACH DATABASE ? AS {alias}", (os.path.join(ARCHIVE_DIR, path),))
+    if create:
+        c.execute(f"CREATE TABLE IF NOT EXISTS {alias}.attendance (id INTEGER PRIMARY KEY AUTOINCREMENT, class_id INTEGER, student_number TEXT, timestamp TEXT, status TEXT)")
+        c.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_attendance_class_student ON attendance (class_id, student_number)")
+    return alias
+
+def attendance_table(c, cid):
+    """Returns the table holding a class's attendance rows, attaching its term archive to `c` if needed."""
+    arch = get_archive(cid)
+    return f"{attach_term(c, arch[1])}.attendance" if arch else "attendance"
+
+def archive_closed_terms(today=None):
+    """Moves the attendance of every class whose end_date has passed into its term archive.
+    Safe to run from several workers at once: each term's classes are picked and moved in one write transaction."""
+    today = today or datetime.now().strftime("%Y-%m-%d")
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    flush_attendance()
+    with sqlite3.connect(DB) as c:
+        terms = [r[0] for r in c.cursor().execute("SELECT DISTINCT end_date FROM classes WHERE end_date != '' AND end_date < ? AND id NOT IN (SELECT class_id FROM attendance_archives) ORDER BY end_date", (today,)).fetchall()]
+    archived = []
+    for term in terms:
+        path = f"term_{term}.db"
+        with flush_lock, sqlite3.connect(DB, timeout=30) as c:
+            # ATTACH is not allowed inside a transaction; the classes are re-selected once the write lock is held
+            alias = attach_term(c, path, create=True)
+            c.execute("BEGIN IMMEDIATE")
+            for (cid,) in c.cursor().execute("SELECT id FROM classes WHERE end_date=? AND id NOT IN (SELECT class_id FROM attendance_archives)", (term,)).fetchall():
+                cur = c.execute("INSERT OR IGNORE INTO attendance_archives (class_id, term, path, snapshot, archived_at) VALUES (?, ?, ?, ?, ?)",
+                                (cid, term, path, os.path.join(f"term_{term}", f"class_{cid}.json.gz"), time.strftime("%Y-%m-%d %H:%M:%S")))
+                if not cur.rowcount: continue
+                discard_pending_attendance(cid)
+                c.execute(f"INSERT INTO {alias}.attendance (class_id, student_number, timestamp, status) SELECT class_id, student_number, timestamp, status FROM attendance WHERE class_id=?", (cid,))
+                c.execute("DELETE FROM attendance WHERE class_id=?", (cid,))
+                archived.append(cid)
+            c.commit()
+    invalidate_meta()
+    # Also rebuilds snapshots lost to a crash or failed write after an earlier pass committed the move
+    write_missing_snapshots()
+    return archived
+
+def write_missing_snapshots():
+    with sqlite3.connect(DB) as c:
+        rows = c.cursor().execute("SELECT class_id, snapshot FROM attendance_archives").fetchall()
+    for cid, snapshot in rows:
+        if os.path.exists(os.path.join(ARCHIVE_DIR, snapshot)): continue
+        try: write_snapshot(cid)
+        except Exception as e: print(f"Error writing snapshot for class {cid}: {e}")
+
+def unarchive_class(cid):
+    """Moves an archived class's attendance back into the hot table."""
+    arch = get_archive(cid)
+    if not arch: return
+    with flush_lock, sqlite3.connect(DB) as c:
+        alias = attach_term(c, arch[1])
+        c.execute(f"INSERT INTO attendance (class_id, student_number, timestamp, status) SELECT class_id, student_number, timestamp, status FROM {alias}.attendance WHERE class_id=?", (cid,))
+        c.execute(f"DELETE FROM {alias}.attendance WHERE class_id=?", (cid,))
+        c.execute("DELETE FROM attendance_archives WHERE class_id=?", (cid,))
+        c.commit()
+    if os.path.exists(os.path.join(ARCHIVE_DIR, arch[2])): os.remove(os.path.join(ARCHIVE_DIR, arch[2]))
+    invalidate_meta()
+
+def write_snapshot(cid):
+    """Writes the columnar snapshot of an archived class: class details, roster, meeting dates and
+    attendance stored column-wise with students, days and statuses dictionary-encoded."""
+    arch = get_archive(cid)
+    with sqlite3.connect(DB) as c:
+        alias = attach_term(c, arch[1])
+        cls = c.cursor().execute(f"SELECT {', '.join(COURSE_FIELDS)} FROM classes WHERE id=?", (cid,)).fetchone()
+        rows = c.cursor().execute(f"SELECT student_number, timestamp, status FROM {alias}.attendance WHERE class_id=? ORDER BY timestamp", (cid,)).fetchall()
+    students = get_class_students_with_details(cid)
+    index = {s[0]: i for i, s in enumerate(students)}
+    day_index, status_index = {}, {}
+    cols = {"student": [], "day": [], "time": [], "status": []}
+    for sn, ts, status in rows:
+        if sn not in index: continue
+        day, t = ts.split(" ")
+        cols["student"].append(index[sn])
+        cols["day"].append(day_index.setdefault(day, len(day_index)))
+        cols["time"].append(t)
+        cols["status"].append(status_index.setdefault(status, len(status_index)))
+    snap = {
+        "version": 1, "class_id": int(cid), "term": arch[0],
+        "class": dict(zip(COURSE_FIELDS, cls)),
+        "dates": list(get_class_schedule(cid)),
+        "students": {k: [s[i] for s in students] for i, k in enumerate(("student_number", "last_name", "first_name", "middle_name", "section"))},
+        "days": list(day_index), "statuses": list(status_index),
+        "attendance": cols,
+    }
+    dest = os.path.join(ARCHIVE_DIR, arch[2])
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"  # several workers may rebuild the same snapshot
+    with gzip.open(tmp, "wt", encoding="utf-8") as f: json.dump(snap, f, separators=(",", ":"))
+    os.replace(tmp, dest)
+    with meta_lock: meta_cache.pop(('snapshot', int(cid)), None)
+
+def load_snapshot(cid):
+    arch = get_archive(cid)
+    def load():
+        path = os.path.join(ARCHIVE_DIR, arch[2])
+        if not os.path.exists(path): write_snapshot(cid)
+        with gzip.open(path, "rt", encoding="utf-8") as f: return json.load(f)
+    return _cached_meta(('snapshot', int(cid)), load)
+
+def load_course_data(cid):
+    """Returns (class row in COURSE_FIELDS order, held meeting dates, roster, {student: {date: (status, time)}}).
+    Archived classes are read from their snapshot, others from the live tables. None if the class is unknown."""
+    if get_archive(cid):
+        snap = load_snapshot(cid)
+        st = snap["students"]
+        students = list(zip(st["student_number"], st["last_name"], st["first_name"], st["middle_name"], st["section"]))
+        att_map = {}
+        a = snap["attendance"]
+        for si, di, t, ki in zip(a["student"], a["day"], a["time"], a["status"]):
+            att_map.setdefault(students[si][0], {})[snap["days"][di]] = (snap["statuses"][ki], t)
+        return tuple(snap["class"][k] for k in COURSE_FIELDS), snap["dates"], students, att_map
+    flush_attendance()
+    with sqlite3.connect(DB) as c:
+        cls = c.cursor().execute(f"SELECT {', '.join(COURSE_FIELDS)} FROM classes WHERE id=?", (cid,)).fetchone()
+        if not cls: return None
+        rows = c.cursor().execute("SELECT student_number, timestamp, status FROM attendance WHERE class_id=?", (cid,)).fetchall()
+    att_map = {}
+    for sn, ts, status in rows:
+        day, t = ts.split(" ")
+        att_map.setdefault(sn, {})[day] = (status, t)
+    return cls, get_class_dates(cid), get_class_students_with_details(cid), att_map
 
 def grab_frames():
     global current_frame
+    load_vision()
+    load_http()
     bytes_data = b''
+    frames, window_start = 0, time.monotonic()
     while True:
         try:
             stream = requests.get(ESP32_STREAM, stream=True, timeout=5)
@@ -293,11 +1102,20 @@ def grab_frames():
                     a = bytes_data.find(b'\xff\xd8'); b = bytes_data.find(b'\xff\xd9')
                     if a != -1 and b != -1:
                         jpg = bytes_data[a:b+2]; bytes_data = bytes_data[b+2:]
-                        img = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
+                        with span("stream_frame_decode_seconds"):
+                            img = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
                         if img is not None:
                             with frame_lock: current_frame = img
+                            metrics.inc("stream_frames_total")
+                            frames += 1
+                        now = time.monotonic()
+                        if now - window_start >= 1:
+                            metrics.set_gauge("stream_fps", round(frames / (now - window_start), 2))
+                            frames, window_start = 0, now
             else: time.sleep(2)
         except: time.sleep(2)
+        metrics.inc("stream_reconnects_total")
+        metrics.set_gauge("stream_fps", 0)
 
 def get_latest_frame():
     with frame_lock: return current_frame.copy() if current_frame is not None else None
@@ -306,8 +1124,17 @@ def generate_mjpeg():
     while True:
         frame = get_latest_frame()
         if frame is None: time.sleep(0.05); continue
-        ret, jpeg = cv2.imencode('.jpg', frame)
-        if ret: yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
+        with span("mjpeg_encode_seconds"):
+            ret, jpeg = cv2.imencode('.jpg', frame)
+        if ret:
+            metrics.inc("mjpeg_frames_total")
+            yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
+
+def notify_lcd(message, timeout=0.5):
+    """Best-effort message to the ESP32 LCD; `message` must already be URL-quoted."""
+    with span("attendance_stage_seconds", stage="lcd"):
+        try: requests.get(f"http://{ESP32_IP}/update_lcd?message={message}", timeout=timeout)
+        except: pass
 
 # ================= ROUTES =================
 @app.route("/login", methods=["GET", "POST"])
@@ -341,6 +1168,7 @@ def dashboard():
     if "professor_id" not in session: return redirect(url_for("login"))
     if request.method == "POST":
         d = request.json
+        if not parse_days(d.get("day")): return jsonify({"error": f"Unrecognised class days: {d.get('day')!r}"}), 400
         add_class(session["professor_id"], d.get("name"), d.get("day"), d.get("start_time"), d.get("end_time"), 
                   d.get("start_date"), d.get("end_date"), d.get("program"), d.get("year"), d.get("section"))
         return jsonify({"status": "added"})
@@ -360,13 +1188,11 @@ def dashboard():
         if det:
             sel_class = {'id': cid, 'name': det[0], 'start_time': det[1], 'end_time': det[2], 'day': det[3], 'program': det[4], 'year': det[5], 'section': det[6], 'start_date': det[7], 'end_date': det[8]}
             if not s_date:
-                s_date = find_nearest_class_date(sel_class['day'], sel_class['start_date'], sel_class['end_date'])
+                s_date = find_nearest_class_date(cid)
             if s_date:
                 try:
-                    s_datetime = datetime.strptime(s_date, "%Y-%m-%d")
-                    start_dt = datetime.strptime(sel_class['start_date'], "%Y-%m-%d")
-                    end_dt = datetime.strptime(sel_class['end_date'], "%Y-%m-%d")
-                    if start_dt <= s_datetime <= end_dt and s_datetime.strftime("%A") == sel_class['day']:
+                    datetime.strptime(s_date, "%Y-%m-%d")
+                    if is_class_date(cid, s_date):
                         stats = get_student_statuses(cid, s_date)
                         present = sum(1 for v in stats.values() if v['status'] == 'on_time')
                         late = sum(1 for v in stats.values() if v['status'] == 'late')
@@ -382,6 +1208,7 @@ def dashboard():
 def edit_class_route():
     if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
     d = request.json
+    if not parse_days(d.get("day")): return jsonify({"error": f"Unrecognised class days: {d.get('day')!r}"}), 400
     edit_class(d.get("class_id"), session["professor_id"], d.get("name"), d.get("day"), d.get("start_time"), d.get("end_time"), d.get("start_date"), d.get("end_date"), d.get("program"), d.get("year"), d.get("section"))
     return jsonify({"status": "edited"})
 
@@ -394,6 +1221,48 @@ def delete_class_route():
     delete_class(d.get("class_id"), session["professor_id"])
     return jsonify({"status": "deleted"})
 
+@app.route("/holidays", methods=["GET", "POST"])
+def holidays_route():
+    if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
+    if request.method == "POST":
+        d = request.json
+        if not d.get("date"): return jsonify({"error": "Missing parameters"}), 400
+        # Removal skips the check so a malformed row saved before validation can still be deleted
+        if not d.get("remove") and not is_valid_date(d.get("date")): return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+        with sqlite3.connect(DB) as c:
+            if d.get("remove"): c.cursor().execute("DELETE FROM holidays WHERE date=?", (d.get("date"),))
+            else: c.cursor().execute("INSERT OR REPLACE INTO holidays (date, name) VALUES (?, ?)", (d.get("date"), d.get("name")))
+            c.commit()
+        invalidate_meta()
+        mark_rollups_stale()
+        return jsonify({"status": "removed" if d.get("remove") else "added"})
+    with sqlite3.connect(DB) as c:
+        return jsonify(c.cursor().execute("SELECT date, name FROM holidays ORDER BY date").fetchall())
+
+@app.route("/cancel_session", methods=["POST"])
+def cancel_session_route():
+    if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
+    d = request.json
+    cid, date = d.get("class_id"), d.get("date")
+    if not cid or not date: return jsonify({"error": "Missing parameters"}), 400
+    if not d.get("restore") and not is_valid_date(date): return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+    if not get_class_details(cid, session["professor_id"]): return jsonify({"error": "Class not found"}), 404
+    with sqlite3.connect(DB) as c:
+        if d.get("restore"): c.cursor().execute("DELETE FROM class_cancellations WHERE class_id=? AND date=?", (cid, date))
+        else: c.cursor().execute("INSERT OR IGNORE INTO class_cancellations (class_id, date) VALUES (?, ?)", (cid, date))
+        c.commit()
+    invalidate_meta()
+    mark_rollups_stale()
+    return jsonify({"status": "restored" if d.get("restore") else "cancelled"})
+
+@app.route("/archive_terms", methods=["POST"])
+def archive_terms_route():
+    if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
+    d = request.json
+    if d.get("username") != session["username"] or not verify_professor_credentials(d.get("username"), d.get("password")):
+        return jsonify({"error": "Invalid credentials"}), 401
+    return jsonify({"status": "archived", "class_ids": archive_closed_terms()})
+
 @app.route("/remove_student_from_class", methods=["POST"])
 def remove_student_from_class_route():
     if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
@@ -414,17 +1283,19 @@ def manual_attendance_route():
     date = d.get("date") or datetime.now().strftime("%Y-%m-%d")
     if not cid or not sn or not date:
         return jsonify({"error": "Missing parameters"}), 400
-    with sqlite3.connect(DB) as c:
-        if not c.cursor().execute("SELECT * FROM class_students WHERE class_id=? AND student_number=?", (cid, sn)).fetchone():
-            return jsonify({"error": "Student not in class"}), 400
+    if not is_valid_date(date): return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+    if get_archive(cid): return jsonify({"error": "Class term is archived"}), 409
+    if sn not in get_class_roster(cid):
+        return jsonify({"error": "Student not in class"}), 400
     today = datetime.now().strftime("%Y-%m-%d")
     if date == today:
-        with sqlite3.connect(DB) as c:
-            start_time = c.cursor().execute("SELECT start_time FROM classes WHERE id=?", (cid,)).fetchone()[0]
+        start_time = get_class_meta(cid)[0]
         status = compute_status(start_time, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     else:
         status = "on_time"
-    log_attendance(cid, sn, status, date)
+    # Go through the buffer so a pending camera mark can't overwrite this one later
+    queue_attendance(cid, sn, status, date)
+    flush_attendance()
     return jsonify({"status": "marked"})
 
 @app.route("/clear_attendance", methods=["POST"])
@@ -438,8 +1309,11 @@ def clear_attendance_route():
     date = d.get("date") or datetime.now().strftime("%Y-%m-%d")
     if not cid or not sn or not date:
         return jsonify({"error": "Missing parameters"}), 400
-    with sqlite3.connect(DB) as c:
-        c.cursor().execute("DELETE FROM attendance WHERE class_id=? AND student_number=? AND timestamp LIKE ?", (cid, sn, f"{date}%"))
+    if not is_valid_date(date): return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+    if get_archive(cid): return jsonify({"error": "Class term is archived"}), 409
+    with flush_lock, sqlite3.connect(DB) as c:
+        discard_pending_attendance(cid, sn, date)
+        _delete_attendance(c.cursor(), "attendance", cid, "student_number=? AND timestamp BETWEEN ? AND ?", (sn, f"{date} 00:00:00", f"{date} 23:59:59"))
         c.commit()
     return jsonify({"status": "cleared"})
 
@@ -460,6 +1334,7 @@ def edit_student_route():
     return jsonify({"status": "edited"})
 
 @app.route("/upload_face", methods=["POST"])
+@vision_route
 def upload_face():
     if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
     sn = request.form.get("student_number")
@@ -467,14 +1342,15 @@ def upload_face():
     file = request.files['file']
     if file.filename == '': return jsonify({"error": "No selected file"}), 400
     if file and file.filename.lower().endswith(('.jpg', '.jpeg')):
-        img = cv2.imdecode(np.frombuffer(file.read(), np.uint8), cv2.IMREAD_COLOR)
+        jpeg = file.read()
+        img = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        if img is None: return jsonify({"error": "Invalid file"}), 400
         rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        encs = face_recognition.face_encodings(rgb)
-        if len(encs) != 1: return jsonify({"error": "Exactly one face must be detected"}), 400
-        with sqlite3.connect(DB) as c:
-            c.cursor().execute("UPDATE students SET encoding=? WHERE student_number=?", (encs[0].tobytes(), sn))
-            c.commit()
-        cv2.imwrite(os.path.join(UPLOADS, f"{sn}.jpg"), img)
+        locations = face_recognition.face_locations(rgb, model=FACE_DETECTION_MODEL)
+        if len(locations) != 1: return jsonify({"error": "Exactly one face must be detected"}), 400
+        enc = face_recognition.face_encodings(rgb, locations, num_jitters=FACE_NUM_JITTERS)[0]
+        # Keep the uploaded bytes as the original; re-encoding would lose quality
+        store_image(sn, jpeg, enc.tobytes())
         return jsonify({"status": "uploaded"})
     return jsonify({"error": "Invalid file"}), 400
 
@@ -504,6 +1380,7 @@ def import_section_students_route():
     return jsonify({"status": "imported", "count": count})
 
 @app.route("/stream")
+@vision_route
 def stream():
     if "professor_id" not in session: return "Unauthorized", 403
     return Response(generate_mjpeg(), mimetype='multipart/x-mixed-replace; boundary=frame')
@@ -511,55 +1388,77 @@ def stream():
 @app.route("/attendance", methods=["GET"])
 def attendance_list():
     if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
+    cid = request.args.get("class_id", type=int)
+    if not cid: return jsonify([])
+    pending = pending_marks(cid)
     with sqlite3.connect(DB) as c:
-        return jsonify(c.cursor().execute("SELECT s.name, a.timestamp, a.status FROM attendance a JOIN students s ON a.student_number = s.student_number WHERE class_id=? ORDER BY a.timestamp DESC LIMIT 50", (request.args.get("class_id"),)).fetchall())
+        table = attendance_table(c, cid)
+        rows = c.cursor().execute(f"SELECT s.name, a.timestamp, a.status, a.student_number FROM {table} a JOIN students s ON a.student_number = s.student_number WHERE class_id=? ORDER BY a.timestamp DESC LIMIT ?", (cid, 50 + len(pending))).fetchall()
+        if not pending: return jsonify([r[:3] for r in rows[:50]])
+        names = dict(c.cursor().execute(f"SELECT student_number, name FROM students WHERE student_number IN ({','.join('?' * len(pending))})", [sn for sn, _ in pending]).fetchall())
+    # Pending marks replace the committed row for the same student and day
+    rows = [r for r in rows if (r[3], r[1].split(" ")[0]) not in pending]
+    rows += [(names.get(sn), ts, status) for (sn, _), (ts, status) in pending.items() if sn in names]
+    rows.sort(key=lambda r: r[1], reverse=True)
+    return jsonify([r[:3] for r in rows[:50]])
 
 @app.route("/capture_attendance", methods=["GET"])
+@vision_route
 def capture_attendance():
     if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
     cid = request.args.get("class_id", type=int)
     if not cid: return jsonify({"error": "Class ID required"}), 400
-    frame = get_latest_frame()
+    if get_archive(cid): return jsonify({"status": "class_archived"})
+    with span("attendance_stage_seconds", stage="frame_copy"):
+        frame = get_latest_frame()
     if frame is None: return jsonify({"error": "No frame"}), 500
 
-    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    encs = face_recognition.face_encodings(rgb)
-    if not encs:
-        try: requests.get(f"http://{ESP32_IP}/update_lcd?message=No%20Face%20Detected", timeout=0.5)
-        except: pass
+    with span("attendance_stage_seconds", stage="cvt_color"):
+        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    with span("attendance_stage_seconds", stage="face_detection"):
+        locations = face_recognition.face_locations(rgb, model=FACE_DETECTION_MODEL)
+    if not locations:
+        notify_lcd("No%20Face%20Detected")
+        metrics.inc("capture_requests_total", outcome="no_face")
         return jsonify({"status": "no_face"})
+    with span("attendance_stage_seconds", stage="face_encoding"):
+        query = face_recognition.face_encodings(rgb, locations[:1], num_jitters=FACE_NUM_JITTERS)[0]
 
-    query = encs[0]
-    ids, names, known_encs = get_all_encodings()
-    if not known_encs: return jsonify({"status": "no_known_faces"})
+    with span("attendance_stage_seconds", stage="gallery_load"):
+        ids, names, known_encs = get_all_encodings()
+    if not known_encs:
+        metrics.inc("capture_requests_total", outcome="no_known_faces")
+        return jsonify({"status": "no_known_faces"})
 
-    dists = face_recognition.face_distance(known_encs, query)
-    best_idx = int(np.argmin(dists))
-    min_dist = dists[best_idx]
+    with span("attendance_stage_seconds", stage="distance"):
+        dists = face_recognition.face_distance(known_encs, query)
+        best_idx = int(np.argmin(dists))
+        min_dist = dists[best_idx]
 
     if min_dist < 0.65:
         sn = ids[best_idx]
-        with sqlite3.connect(DB) as c:
-            if not c.cursor().execute("SELECT * FROM class_students WHERE class_id=? AND student_number=?", (cid, sn)).fetchone():
-                try: requests.get(f"http://{ESP32_IP}/update_lcd?message=Not%20In%20Class", timeout=0.5)
-                except: pass
-                return jsonify({"status": "not_in_class"})
-            start_time = c.cursor().execute("SELECT start_time FROM classes WHERE id=?", (cid,)).fetchone()[0]
-            row = c.cursor().execute("SELECT last_name, first_name FROM students WHERE student_number=?", (sn,)).fetchone()
-            class_row = c.cursor().execute("SELECT name, section FROM classes WHERE id=?", (cid,)).fetchone()
-            if row:
-                lname = row[0] if row[0] else ""
-                fname = row[1] if row[1] else ""
-                fname_short = fname.split()[0] if fname else ""
-                lcd_name = f"{lname}, {fname_short}"
-            else:
-                lcd_name = "Unknown"
-            if class_row:
-                cls_name = class_row[0] if class_row[0] else ""
-                cls_section = class_row[1] if class_row[1] else ""
-                lcd_class = f"{cls_name} {cls_section}"
-            else:
-                lcd_class = "Unknown"
+        with span("attendance_stage_seconds", stage="metadata"):
+            in_class = sn in get_class_roster(cid)
+            class_row = get_class_meta(cid)
+            row = get_student_meta(sn)
+        if not in_class:
+            notify_lcd("Not%20In%20Class")
+            metrics.inc("capture_requests_total", outcome="not_in_class")
+            return jsonify({"status": "not_in_class"})
+        start_time = class_row[0]
+        if row:
+            lname = row[0] if row[0] else ""
+            fname = row[1] if row[1] else ""
+            fname_short = fname.split()[0] if fname else ""
+            lcd_name = f"{lname}, {fname_short}"
+        else:
+            lcd_name = "Unknown"
+        if class_row:
+            cls_name = class_row[1] if class_row[1] else ""
+            cls_section = class_row[2] if class_row[2] else ""
+            lcd_class = f"{cls_name} {cls_section}"
+        else:
+            lcd_class = "Unknown"
 
         status = compute_status(start_time, time.strftime("%Y-%m-%d %H:%M:%S"))
         if status == "on_time":
@@ -568,18 +1467,18 @@ def capture_attendance():
             lcd_status = "Late"
         else:
             lcd_status = "Absent"
-        log_attendance(cid, sn, status)
-        try:
-            msg = f"{urllib.parse.quote(lcd_name)}|{urllib.parse.quote(lcd_class)}|{urllib.parse.quote(lcd_status)}"
-            requests.get(f"http://{ESP32_IP}/update_lcd?message={msg}", timeout=1)
-        except: pass
+        with span("attendance_stage_seconds", stage="db_write"):
+            queue_attendance(cid, sn, status)
+        notify_lcd(f"{urllib.parse.quote(lcd_name)}|{urllib.parse.quote(lcd_class)}|{urllib.parse.quote(lcd_status)}", timeout=1)
+        metrics.inc("capture_requests_total", outcome="match")
         return jsonify({"status": "match", "student_number": sn, "name": lcd_name, "attendance_status": status})
     else:
-        try: requests.get(f"http://{ESP32_IP}/update_lcd?message=Unknown%20Face|Access%20Denied", timeout=0.5)
-        except: pass
+        notify_lcd("Unknown%20Face|Access%20Denied")
+        metrics.inc("capture_requests_total", outcome="unknown")
         return jsonify({"status": "unknown"})
 
 @app.route("/capture_global", methods=["GET"])
+@vision_route
 def capture_global():
     if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
     sn = request.args.get("student_number")
@@ -587,15 +1486,41 @@ def capture_global():
     frame = get_latest_frame()
     if frame is None: return jsonify({"error": "No frame"}), 500
     rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    encs = face_recognition.face_encodings(rgb)
-    if len(encs) != 1: return jsonify({"error": "Exactly one face must be detected"}), 400
-    enc = encs[0]
-    with sqlite3.connect(DB) as c:
-        c.cursor().execute("UPDATE students SET encoding=? WHERE student_number=?", (enc.tobytes(), sn))
-        c.commit()
-    cv2.imwrite(os.path.join(UPLOADS, f"{sn}.jpg"), frame)
+    locations = face_recognition.face_locations(rgb, model=FACE_DETECTION_MODEL)
+    if len(locations) != 1: return jsonify({"error": "Exactly one face must be detected"}), 400
+    enc = face_recognition.face_encodings(rgb, locations, num_jitters=FACE_NUM_JITTERS)[0]
+    # Encoding the JPEG here is cheap next to detection and lets the hash be stored with the encoding
+    store_image(sn, cv2.imencode(".jpg", frame)[1].tobytes(), enc.tobytes())
     return jsonify({"status": "updated"})
 
+@app.route("/student_image/<sn>")
+def student_image(sn):
+    if "professor_id" not in session: return "Unauthorized", 403
+    size = request.args.get("size", 128, type=int)
+    if size not in THUMB_SIZES: return jsonify({"error": f"size must be one of {list(THUMB_SIZES)}"}), 400
+    thumb = get_thumbnail(sn, size)
+    if thumb is None: return "Not found", 404
+    etag, data = thumb
+    if request.if_none_match.contains(etag): return Response(status=304)
+    out = make_response(data)
+    out.headers["Content-type"] = "image/jpeg"
+    out.headers["ETag"] = f'"{etag}"'
+    out.headers["Cache-Control"] = "private, max-age=3600"
+    return out
+
+@app.route("/reencode_faces", methods=["GET", "POST"])
+def reencode_faces_route():
+    """POST (with credentials) recomputes all stored encodings from the original photos in the background; GET reports progress."""
+    if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
+    if request.method == "POST":
+        if ROLE == "web": return jsonify({"error": "Camera routes are served by the vision worker"}), 503
+        d = request.json
+        if d.get("username") != session["username"] or not verify_professor_credentials(d.get("username"), d.get("password")):
+            return jsonify({"error": "Invalid credentials"}), 401
+        if not start_reencode(): return jsonify({"error": "Re-encode already running"}), 409
+        return jsonify({"status": "started"})
+    return jsonify(reencode_status)
+
 # ================= NEW EXPORT FUNCTIONS =================
 
 @app.route("/export_session")
@@ -607,30 +1532,82 @@ def export_session():
     si = StringIO()
     cw = csv.writer(si)
     
-    with sqlite3.connect(DB) as c:
-        cls = c.cursor().execute("SELECT name, section, program, year FROM classes WHERE id=?", (cid,)).fetchone()
-        c_name = cls[0] if cls else "Unknown Class"
-        
-        cw.writerow([f"Class: {c_name}"])
-        cw.writerow([f"Date: {t_date}"])
-        cw.writerow([])
-        cw.writerow(["Student Number", "Last Name", "First Name", "Middle Name", "Status", "Time In"])
-        
-        students = get_class_students_with_details(cid)
-        # Fetch detailed time for this date
-        att_rows = c.cursor().execute("SELECT student_number, status, timestamp FROM attendance WHERE class_id=? AND timestamp LIKE ?", (cid, f"{t_date}%")).fetchall()
+    if cid and get_archive(cid):
+        # Closed term: everything comes from the snapshot
+        cls, _, students, course_att = load_course_data(cid)
+        c_name = cls[0]
+        att_map = {sn: {'status': days[t_date][0], 'time': days[t_date][1]} for sn, days in course_att.items() if t_date in days}
+    else:
+        flush_attendance()
+        with sqlite3.connect(DB) as c:
+            cls = c.cursor().execute("SELECT name, section, program, year FROM classes WHERE id=?", (cid,)).fetchone()
+            c_name = cls[0] if cls else "Unknown Class"
+            # Fetch detailed time for this date
+            att_rows = c.cursor().execute("SELECT student_number, status, timestamp FROM attendance WHERE class_id=? AND timestamp BETWEEN ? AND ?", (cid, f"{t_date} 00:00:00", f"{t_date} 23:59:59")).fetchall()
         att_map = {r[0]: {'status': r[1], 'time': r[2].split(" ")[1]} for r in att_rows}
-        
-        for row in students:
-            sn, ln, fn, mn, _ = row
-            record = att_map.get(sn, {'status': 'ABSENT', 'time': '-'})
-            cw.writerow([sn, ln, fn, mn, record['status'].upper(), record['time']])
+        students = get_class_students_with_details(cid)
+
+    cw.writerow([f"Class: {c_name}"])
+    cw.writerow([f"Date: {t_date}"])
+    cw.writerow([])
+    cw.writerow(["Student Number", "Last Name", "First Name", "Middle Name", "Status", "Time In"])
+    
+    for row in students:
+        sn, ln, fn, mn, _ = row
+        record = att_map.get(sn, {'status': 'ABSENT', 'time': '-'})
+        cw.writerow([sn, ln, fn, mn, record['status'].upper(), record['time']])
             
     out = make_response(si.getvalue())
     out.headers["Content-Disposition"] = f"attachment; filename=Attendance_{t_date}_{c_name}.csv"
     out.headers["Content-type"] = "text/csv"
     return out
 
+def write_course_matrix(cw, cls, dates, students, att_map):
+    """Writes one class block: header lines, then a row per student with a P/L/A column per date and totals."""
+    c_name, c_day, c_start_date, c_end_date, c_start_time, c_end_time, c_sec, c_prog, c_yr = cls
+
+    # Header Info
+    cw.writerow([f"Course: {c_name}"])
+    cw.writerow([f"Section: {c_yr} {c_prog} {c_sec}"])
+    cw.writerow([f"Schedule: {c_day} {c_start_time}-{c_end_time}"])
+    cw.writerow([])
+
+    # Headers: Student Info + Dates + Summary
+    headers = ["Student No.", "Name"] + list(dates) + ["Present", "Late", "Absent", "Rate (%)"]
+    cw.writerow(headers)
+
+    # Build Rows
+    for stud in students:
+        sn, ln, fn, mn, _ = stud
+        mi = f" {mn[0]}." if mn and len(mn) > 0 else ""
+        full_name = f"{ln}, {fn}{mi}"
+
+        row = [sn, full_name]
+        p_count, l_count, a_count = 0, 0, 0
+
+        for d in dates:
+            status = att_map.get(sn, {}).get(d, (None,))[0]
+            if status == 'on_time':
+                row.append("P")
+                p_count += 1
+            elif status == 'late':
+                row.append("L")
+                l_count += 1
+            else:
+                # Absent if no record found for a past date
+                row.append("A")
+                a_count += 1
+
+        total_days = len(dates)
+        rate = ((p_count + l_count) / total_days * 100) if total_days > 0 else 0.0
+
+        row.append(p_count)
+        row.append(l_count)
+        row.append(a_count)
+        row.append(f"{rate:.2f}")
+
+        cw.writerow(row)
+
 @app.route("/export_course")
 def export_course():
     """Exports a matrix of all attendance data for a specific class (Dates vs Students)."""
@@ -639,70 +1616,10 @@ def export_course():
     si = StringIO()
     cw = csv.writer(si)
     
-    with sqlite3.connect(DB) as c:
-        # Get Class Info
-        cls = c.cursor().execute("SELECT name, day, start_date, end_date, start_time, end_time, section, program, year FROM classes WHERE id=?", (cid,)).fetchone()
-        if not cls: return "Class not found", 404
-        
-        c_name, c_day, c_start_date, c_end_date, c_start_time, c_end_time, c_sec, c_prog, c_yr = cls
-        
-        # Header Info
-        cw.writerow([f"Course: {c_name}"])
-        cw.writerow([f"Section: {c_yr} {c_prog} {c_sec}"])
-        cw.writerow([f"Schedule: {c_day} {c_start_time}-{c_end_time}"])
-        cw.writerow([])
-        
-        # Generate all class dates from start date until today
-        dates = get_class_dates(c_day, c_start_date, c_end_date)
-        
-        # Headers: Student Info + Dates + Summary
-        headers = ["Student No.", "Name"] + dates + ["Present", "Late", "Absent", "Rate (%)"]
-        cw.writerow(headers)
-        
-        # Get Students
-        students = get_class_students_with_details(cid)
-        
-        # Get All Attendance for this class
-        att_rows = c.cursor().execute("SELECT student_number, timestamp, status FROM attendance WHERE class_id=?", (cid,)).fetchall()
-        
-        # Map: student_no -> date -> status
-        att_map = {}
-        for sn, ts, status in att_rows:
-            date_str = ts.split(" ")[0] # Extract YYYY-MM-DD
-            if sn not in att_map: att_map[sn] = {}
-            att_map[sn][date_str] = status
-            
-        # Build Rows
-        for stud in students:
-            sn, ln, fn, mn, _ = stud
-            mi = f" {mn[0]}." if mn and len(mn) > 0 else ""
-            full_name = f"{ln}, {fn}{mi}"
-            
-            row = [sn, full_name]
-            p_count, l_count, a_count = 0, 0, 0
-            
-            for d in dates:
-                status = att_map.get(sn, {}).get(d, None)
-                if status == 'on_time':
-                    row.append("P")
-                    p_count += 1
-                elif status == 'late':
-                    row.append("L")
-                    l_count += 1
-                else:
-                    # Absent if no record found for a past date
-                    row.append("A")
-                    a_count += 1
-            
-            total_days = len(dates)
-            rate = ((p_count + l_count) / total_days * 100) if total_days > 0 else 0.0
-            
-            row.append(p_count)
-            row.append(l_count)
-            row.append(a_count)
-            row.append(f"{rate:.2f}")
-            
-            cw.writerow(row)
+    data = load_course_data(cid) if cid else None
+    if not data: return "Class not found", 404
+    write_course_matrix(cw, *data)
+    c_name = data[0][0]
             
     out = make_response(si.getvalue())
     out.headers["Content-Disposition"] = f"attachment; filename=Summary_{c_name}_{datetime.now().strftime('%Y%m%d')}.csv"
@@ -745,73 +1662,18 @@ def export_all_attendance():
     
     with sqlite3.connect(DB) as c:
         # Get all classes for the professor
-        classes = c.cursor().execute("SELECT id, name, day, start_date, end_date, start_time, end_time, section, program, year FROM classes WHERE professor_id=?", (pid,)).fetchall()
-        
-        for cls in classes:
-            cid, c_name, c_day, c_start_date, c_end_date, c_start_time, c_end_time, c_sec, c_prog, c_yr = cls
-            
-            # --- BLOCK HEADER ---
-            cw.writerow([f"Course: {c_name}"])
-            cw.writerow([f"Section: {c_yr} {c_prog} {c_sec}"])
-            cw.writerow([f"Schedule: {c_day} {c_start_time}-{c_end_time}"])
-            cw.writerow([]) # Empty row for spacing
-            
-            # --- CALCULATE COLUMNS (DATES) ---
-            dates = get_class_dates(c_day, c_start_date, c_end_date)
-            
-            # --- TABLE HEADER ---
-            # Columns: Student No | Name | [Date 1] | [Date 2] | ... | Present | Late | Absent | Rate (%)
-            headers = ["Student No.", "Name"] + dates + ["Present", "Late", "Absent", "Rate (%)"]
-            cw.writerow(headers)
-            
-            # --- FETCH DATA ---
-            students = get_class_students_with_details(cid)
-            att_rows = c.cursor().execute("SELECT student_number, timestamp, status FROM attendance WHERE class_id=?", (cid,)).fetchall()
-            
-            # Map: student_no -> date -> status
-            att_map = {}
-            for sn, ts, status in att_rows:
-                date_str = ts.split(" ")[0] # Extract YYYY-MM-DD
-                if sn not in att_map: att_map[sn] = {}
-                att_map[sn][date_str] = status
-            
-            # --- BUILD STUDENT ROWS ---
-            for stud in students:
-                sn, ln, fn, mn, _ = stud
-                mi = f" {mn[0]}." if mn and len(mn) > 0 else ""
-                full_name = f"{ln}, {fn}{mi}"
-                
-                row = [sn, full_name]
-                p_count, l_count, a_count = 0, 0, 0
-                
-                # Loop through every valid class date for this semester
-                for d in dates:
-                    status = att_map.get(sn, {}).get(d, None)
-                    if status == 'on_time':
-                        row.append("P")
-                        p_count += 1
-                    elif status == 'late':
-                        row.append("L")
-                        l_count += 1
-                    else:
-                        row.append("A")
-                        a_count += 1
-                
-                total_days = len(dates)
-                rate = ((p_count + l_count) / total_days * 100) if total_days > 0 else 0.0
-                
-                # Add Summary Columns
-                row.append(p_count)
-                row.append(l_count)
-                row.append(a_count)
-                row.append(f"{rate:.2f}")
-                
-                cw.writerow(row)
-            
-            # --- SEPARATOR BETWEEN CLASSES ---
-            cw.writerow([])
-            cw.writerow([])
-            cw.writerow([])
+        class_ids = [r[0] for r in c.cursor().execute("SELECT id FROM classes WHERE professor_id=?", (pid,)).fetchall()]
+
+    for cid in class_ids:
+        # Archived classes come from their snapshots, active ones from the live tables
+        data = load_course_data(cid)
+        if not data: continue
+        write_course_matrix(cw, *data)
+
+        # --- SEPARATOR BETWEEN CLASSES ---
+        cw.writerow([])
+        cw.writerow([])
+        cw.writerow([])
 
     out = make_response(si.getvalue())
     out.headers["Content-Disposition"] = f"attachment; filename=All_Attendance_Matrix_{datetime.now().strftime('%Y%m%d')}.csv"
@@ -831,8 +1693,72 @@ def get_student_statuses_route():
     absent = sum(1 for v in statuses.values() if v['status'] == 'absent')
     return jsonify({"statuses": statuses, "present": present, "late": late, "absent": absent})
 
+# ================= ANALYTICS ROUTES =================
+@app.route("/analytics/students", methods=["GET"])
+def analytics_students():
+    if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
+    a = request.args
+    rows = student_rates(a.get("below", type=float), a.get("year"), a.get("program"), a.get("section"), a.get("offset", 0, type=int), a.get("limit", 50, type=int))
+    return jsonify({"students": rows})
+
+@app.route("/analytics/at_risk", methods=["GET"])
+def analytics_at_risk():
+    if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
+    a = request.args
+    threshold = a.get("threshold", AT_RISK_THRESHOLD, type=float)
+    rows = student_rates(threshold, a.get("year"), a.get("program"), a.get("section"), a.get("offset", 0, type=int), a.get("limit", 50, type=int))
+    return jsonify({"threshold": threshold, "students": rows})
+
+@app.route("/analytics/student", methods=["GET"])
+def analytics_student():
+    if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
+    sn = request.args.get("student_number")
+    if not sn: return jsonify({"error": "Student number required"}), 400
+    return jsonify({"student_number": sn, "classes": student_class_rates(sn)})
+
+@app.route("/analytics/class_weekly", methods=["GET"])
+def analytics_class_weekly():
+    if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
+    cid = request.args.get("class_id", type=int)
+    if not cid: return jsonify({"error": "Class ID required"}), 400
+    return jsonify({"class_id": cid, "weeks": class_weekly_rates(cid)})
+
+# ================= METRICS =================
+@app.route("/metrics")
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/profiler", methods=["GET", "POST"])
+def profiler_route():
+    """GET returns the sampled stacks (JSON, or folded text with ?format=folded); POST {"enabled": bool} toggles sampling."""
+    if "professor_id" not in session: return jsonify({"error": "Unauthorized"}), 403
+    if request.method == "POST":
+        d = request.json
+        if d.get("reset"): metrics.reset_profile()
+        if d.get("enabled"):
+            try: interval_ms = float(d.get("interval_ms", 10))
+            except (TypeError, ValueError): interval_ms = float("nan")
+            if not 1 <= interval_ms <= 10000: return jsonify({"error": "interval_ms must be a number between 1 and 10000"}), 400
+            metrics.start_profiler(interval_ms / 1000)
+        elif "enabled" in d: metrics.stop_profiler()
+        return jsonify({"running": metrics.profiler_running()})
+    if request.args.get("format") == "folded":
+        return Response(metrics.profile_folded(request.args.get("limit", type=int)), mimetype="text/plain")
+    return jsonify(metrics.profile_summary(request.args.get("limit", 20, type=int)))
+
 if __name__ == "__main__":
     init_db()
-    t = threading.Thread(target=grab_frames, daemon=True)
-    t.start()
-    app.run(host="0.0.0.0", port=8000, debug=False, use_reloader=False)
\ No newline at end of file
+    # Turn SIGTERM into a normal exit so atexit flushes buffered attendance
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    start_attendance_flusher()
+    try:
+        archived = archive_closed_terms()
+        if archived: print(f"Archived attendance for {len(archived)} closed classes")
+    except sqlite3.Error as e:
+        # Another worker may be archiving the same terms; whoever gets the lock does the work
+        print(f"Error archiving closed terms: {e}")
+    start_image_writer()
+    if ROLE != "web":
+        load_vision()
+        threading.Thread(target=grab_frames, daemon=True).start()
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8000)), debug=False, use_reloader=False)
\ No newline at end of file